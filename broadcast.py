@@ -0,0 +1,90 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, NamedTuple
+
+from aiogram.utils.exceptions import RetryAfter
+
+# Общий бюджет рассылок: Telegram пропускает около 30 сообщений в секунду на бота
+GLOBAL_RATE = 30
+# Пауза между вызовами в один и тот же чат
+PER_CHAT_INTERVAL = 1.0
+# Сколько чатов обрабатывается одновременно
+MAX_CONCURRENCY = 25
+# Сколько раз повторять вызов после RetryAfter
+MAX_RETRIES = 3
+
+
+class BroadcastResult(NamedTuple):
+    sent: Dict[Hashable, Any]
+    failed: Dict[Hashable, Exception]
+    elapsed: float
+
+
+# Рассылка по многим чатам: ограниченное число одновременных чатов, общий бюджет
+# вызовов в секунду и интервал внутри чата. RetryAfter откладывает только свой чат,
+# остальные продолжают отправляться. Один экземпляр на процесс — бюджет общий
+# для автопостинга и закрепов
+class Broadcaster:
+    def __init__(self, rate: float = GLOBAL_RATE, per_chat_interval: float = PER_CHAT_INTERVAL,
+                 concurrency: int = MAX_CONCURRENCY):
+        self.rate = rate
+        self.per_chat_interval = per_chat_interval
+        self.concurrency = concurrency
+        self._next_slot = 0.0
+        self._chat_ready: Dict[Hashable, float] = {}
+        self.calls = 0
+        self.retries = 0
+
+    async def _global_slot(self):
+        # Равномерная раздача слотов: каждый вызов занимает 1/rate секунды общего бюджета
+        now = time.monotonic()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + 1 / self.rate
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def call(self, chat_id: Hashable, func: Callable[..., Awaitable], *args, **kwargs):
+        # Один вызов Bot API в чат с соблюдением обоих лимитов
+        for attempt in range(MAX_RETRIES + 1):
+            delay = self._chat_ready.get(chat_id, 0) - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self._global_slot()
+            self._chat_ready[chat_id] = time.monotonic() + self.per_chat_interval
+            self.calls += 1
+            try:
+                return await func(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == MAX_RETRIES:
+                    raise
+                self.retries += 1
+                self._chat_ready[chat_id] = time.monotonic() + e.timeout
+                logging.warning(f"[BROADCAST] RetryAfter {e.timeout} с в чате {chat_id}")
+
+    async def run(self, targets: Iterable[Hashable], action: Callable[[Hashable], Awaitable]) -> BroadcastResult:
+        # action(chat_id) делает вызовы через self.call; ошибка одного чата не останавливает рассылку
+        started = time.monotonic()
+        sent: Dict[Hashable, Any] = {}
+        failed: Dict[Hashable, Exception] = {}
+        pending = iter(targets)
+
+        async def worker():
+            for chat_id in pending:
+                try:
+                    sent[chat_id] = await action(chat_id)
+                except Exception as e:
+                    failed[chat_id] = e
+                    logging.error(f"[BROADCAST] Не удалось отправить в {chat_id}: {e}")
+
+        await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+        self._forget_idle_chats()
+        return BroadcastResult(sent, failed, time.monotonic() - started)
+
+    def _forget_idle_chats(self):
+        now = time.monotonic()
+        for chat_id in [chat_id for chat_id, ready in self._chat_ready.items() if ready <= now]:
+            del self._chat_ready[chat_id]
+
+
+broadcaster = Broadcaster()
@@ -0,0 +1,51 @@
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+
+# Ограниченный по размеру кэш с временем жизни записей (LRU-вытеснение)
+class TTLCache:
+    def __init__(self, maxsize: int = 10000, ttl: float = 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.get(key)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        self._data[key] = (time.monotonic() + (ttl or self.ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.pop(key, None)
+        return item[1] if item else default
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+# Статус участника: (chat_id, user_id) -> "member" / "restricted" / "administrator" / ...
+member_cache = TTLCache(maxsize=50000, ttl=300)
+
+# Цели автопостинга: username/ссылка чата -> числовой chat_id из get_chat
+chat_id_cache = TTLCache(maxsize=10000, ttl=6 * 3600)
+
+# Права самого бота: chat_id -> ChatMember бота (False — получить не удалось).
+# Актуальны за счёт my_chat_member, TTL — только страховка от пропущенных обновлений
+bot_rights_cache = TTLCache(maxsize=10000, ttl=6 * 3600)
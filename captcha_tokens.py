@@ -0,0 +1,63 @@
+import base64
+import hashlib
+import hmac
+import os
+import struct
+import time
+from typing import NamedTuple, Optional
+
+from config import TOKEN
+
+# Ключ подписи выводится из токена бота — отдельный секрет хранить не нужно
+SECRET = hashlib.sha256(b"captcha-token:" + TOKEN.encode()).digest()
+PREFIX = "cp:"
+# chat_id, user_id, id вопроса, срок (сек эпохи), выбранный ответ, хэш правильного ответа
+PAYLOAD = struct.Struct(">qqIIh4s")
+MAC_SIZE = 8
+# user_id общей капчи рейд-режима: ответить может любой из перечисленных в сообщении
+ANY_USER = 0
+
+
+class CaptchaToken(NamedTuple):
+    chat_id: int
+    user_id: int
+    challenge_id: int
+    expires: int
+    answer: int
+    correct: bool
+
+
+def new_challenge_id() -> int:
+    return int.from_bytes(os.urandom(4), "big")
+
+
+def _answer_tag(challenge_id: int, answer: int) -> bytes:
+    return hmac.new(SECRET, struct.pack(">Ih", challenge_id, answer), hashlib.sha256).digest()[:4]
+
+
+# callback_data кнопки: "cp:" + base64url(payload + hmac) — 54 символа, в лимит Telegram 64 байта
+def sign(chat_id: int, user_id: int, challenge_id: int, expires: int, answer: int, correct_answer: int) -> str:
+    payload = PAYLOAD.pack(chat_id, user_id, challenge_id, expires, answer, _answer_tag(challenge_id, correct_answer))
+    mac = hmac.new(SECRET, payload, hashlib.sha256).digest()[:MAC_SIZE]
+    return PREFIX + base64.urlsafe_b64encode(payload + mac).rstrip(b"=").decode()
+
+
+# Проверка без обращения к базе: None — подделка, битые данные или истёкший срок
+def verify(data: str) -> Optional[CaptchaToken]:
+    if not data.startswith(PREFIX):
+        return None
+    raw = data[len(PREFIX):]
+    try:
+        blob = base64.urlsafe_b64decode(raw + "=" * (-len(raw) % 4))
+    except ValueError:
+        return None
+    if len(blob) != PAYLOAD.size + MAC_SIZE:
+        return None
+    payload, mac = blob[:PAYLOAD.size], blob[PAYLOAD.size:]
+    if not hmac.compare_digest(mac, hmac.new(SECRET, payload, hashlib.sha256).digest()[:MAC_SIZE]):
+        return None
+    chat_id, user_id, challenge_id, expires, answer, tag = PAYLOAD.unpack(payload)
+    if expires < time.time():
+        return None
+    correct = hmac.compare_digest(tag, _answer_tag(challenge_id, answer))
+    return CaptchaToken(chat_id, user_id, challenge_id, expires, answer, correct)
@@ -0,0 +1,142 @@
+import logging
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Set
+
+from aiogram import types
+from aiogram.utils.exceptions import BotBlocked, BotKicked, ChatNotFound, GroupDeactivated, MigrateToChat, \
+    Unauthorized, UserDeactivated
+
+from broadcast import broadcaster, BroadcastResult
+from database import db
+
+# Ошибки, после которых в чат больше нельзя писать: бот выгнан или заблокирован (403), чат удалён или закрыт
+DEAD_CHAT_ERRORS = (BotKicked, BotBlocked, UserDeactivated, ChatNotFound, GroupDeactivated)
+# 403 без своего класса в aiogram приходят голым Unauthorized — узнаём их по тексту
+# ("Forbidden: bot is not a member of the supergroup chat")
+DEAD_CHAT_DESCRIPTIONS = ("not a member", "kicked", "blocked", "deactivated", "chat was deleted")
+ACTIVE_STATUSES = ("creator", "administrator", "member")
+
+
+# Здоровье чатов для рассылок: обновления my_chat_member и ошибки отправки помечают
+# чаты неактивными (chats.is_active), переезд группы в супергруппу переносит настройки.
+# Неактивные чаты отсеиваются до рассылки, без обращений к API
+def is_dead_chat_error(error: Exception) -> bool:
+    if isinstance(error, DEAD_CHAT_ERRORS):
+        return True
+    description = str(error).lower()
+    return (isinstance(error, Unauthorized) and description.startswith("forbidden")
+            and any(text in description for text in DEAD_CHAT_DESCRIPTIONS))
+
+
+def is_token_error(error: Exception) -> bool:
+    # 401: токен отозван или неверен — ошибка бота целиком, а не чата
+    return isinstance(error, Unauthorized) and not str(error).lower().startswith("forbidden")
+
+
+class ChatHealth:
+    def __init__(self):
+        # Старый id -> новый после миграции; нужен для целей, которых нет в chats
+        self._migrated: Dict[int, int] = {}
+        # Неактивные чаты вне таблицы chats (цели автопостинга по ссылкам) — до перезапуска
+        self._dead: Set[int] = set()
+        self.deactivated = 0
+        self.reactivated = 0
+        self.migrated = 0
+        self.skipped = 0
+
+    def resolve(self, chat_id: int) -> int:
+        while chat_id in self._migrated:
+            chat_id = self._migrated[chat_id]
+        return chat_id
+
+    async def is_active(self, chat_id: int) -> bool:
+        settings = await db.get_chat(chat_id)
+        if settings is None:
+            return chat_id not in self._dead
+        return bool(settings.is_active)
+
+    async def deactivate(self, chat_id: int, reason: str):
+        settings = await db.get_chat(chat_id)
+        if settings is None:
+            self._dead.add(chat_id)
+        elif settings.is_active:
+            await db.update_chat_settings(chat_id, is_active=0)
+        else:
+            return
+        self.deactivated += 1
+        logging.warning(f"[HEALTH] Чат {chat_id} помечен неактивным: {reason}")
+
+    async def activate(self, chat_id: int):
+        self._dead.discard(chat_id)
+        settings = await db.get_chat(chat_id)
+        if settings is not None and not settings.is_active:
+            await db.update_chat_settings(chat_id, is_active=1)
+            self.reactivated += 1
+            logging.info(f"[HEALTH] Чат {chat_id} снова активен")
+
+    async def migrate(self, old_chat_id: int, new_chat_id: int):
+        if self._migrated.get(old_chat_id) == new_chat_id:
+            return
+        self._migrated[old_chat_id] = new_chat_id
+        self._dead.discard(new_chat_id)
+        await db.migrate_chat(old_chat_id, new_chat_id)
+        self.migrated += 1
+        logging.info(f"[HEALTH] Чат {old_chat_id} стал супергруппой {new_chat_id}")
+
+    async def report(self, chat_id: int, error: Exception) -> Optional[int]:
+        # Разбор ошибки отправки; возвращает новый id, если группа переехала
+        if isinstance(error, MigrateToChat):
+            await self.migrate(chat_id, error.migrate_to_chat_id)
+            return error.migrate_to_chat_id
+        if is_dead_chat_error(error):
+            await self.deactivate(chat_id, str(error))
+        elif is_token_error(error):
+            # Токен недействителен — чаты не трогаем
+            raise error
+        return None
+
+    async def on_my_chat_member(self, update: types.ChatMemberUpdated):
+        status = update.new_chat_member.status
+        if status in ACTIVE_STATUSES or (status == "restricted" and update.new_chat_member.can_send_messages):
+            await self.activate(update.chat.id)
+        else:
+            await self.deactivate(update.chat.id, f"статус бота {status}")
+
+    async def run(self, targets: Iterable[int], action: Callable[[int], Awaitable]) -> BroadcastResult:
+        # broadcaster.run только по живым чатам; переехавшие группы получают повтор по новому id.
+        # Ошибки MigrateToChat остаются в failed — по ним вызывающий обновляет свои списки целей
+        chat_ids = []
+        for chat_id in targets:
+            chat_id = self.resolve(chat_id)
+            if await self.is_active(chat_id):
+                chat_ids.append(chat_id)
+            else:
+                self.skipped += 1
+        result = await broadcaster.run(chat_ids, action)
+        moved = {}
+        for chat_id, error in result.failed.items():
+            # Ошибка одного чата не должна срывать разбор остальных и учёт отправленного у вызывающего
+            try:
+                new_chat_id = await self.report(chat_id, error)
+            except Unauthorized:
+                logging.critical(f"[HEALTH] Токен бота недействителен: {error}")
+                continue
+            if new_chat_id is not None and new_chat_id not in result.sent:
+                moved[new_chat_id] = chat_id
+        if not moved:
+            return result
+        retry = await broadcaster.run(moved, action)
+        result.sent.update(retry.sent)
+        result.failed.update(retry.failed)
+        return result._replace(elapsed=result.elapsed + retry.elapsed)
+
+    async def stats(self) -> Dict[str, int]:
+        return {
+            "inactive": sum(1 for chat in await db.get_all_chats() if not chat.is_active) + len(self._dead),
+            "deactivated": self.deactivated,
+            "reactivated": self.reactivated,
+            "migrated": self.migrated,
+            "skipped": self.skipped,
+        }
+
+
+chat_health = ChatHealth()
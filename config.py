@@ -1,2 +1,22 @@
 TOKEN = "6491432639:AAF2fOkDwQpTD-qXnqmgXERBoG43-g3B9W8"
-ADMINS_ID = (67064276,)
\ No newline at end of file
+ADMINS_ID = (67064276,)
+
+# Получение обновлений: "polling" или "webhook"
+MODE = "polling"
+
+# Webhook: публичный адрес (https) и путь, на который Telegram шлёт обновления.
+# Пустой WEBHOOK_SECRET — секрет выводится из токена
+WEBHOOK_URL = "https://example.com"
+WEBHOOK_PATH = "/webhook"
+WEBHOOK_SECRET = ""
+# Сколько одновременных HTTPS-соединений открывает Telegram (1-100)
+WEBHOOK_MAX_CONNECTIONS = 40
+# Локальный aiohttp-сервер (за nginx/прокси)
+WEBAPP_HOST = "127.0.0.1"
+WEBAPP_PORT = 8080
+# Очередь принятых обновлений и число воркеров, которые её разбирают
+UPDATE_QUEUE_SIZE = 1000
+UPDATE_WORKERS = 32
+
+# Свой сервер Bot API (локальный telegram-bot-api или фейковый для тестов); пусто — api.telegram.org
+API_SERVER_URL = ""
@@ -0,0 +1,73 @@
+from datetime import datetime, timedelta
+from typing import FrozenSet
+
+# Поля cron-выражения: минута, час, день месяца, месяц, день недели (0 и 7 — воскресенье)
+FIELD_RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+# Сколько дней вперёд искать срабатывание, прежде чем признать выражение пустым ("30 2 31 2 *")
+MAX_LOOKAHEAD_DAYS = 366 * 5
+
+
+def _parse_field(field: str, low: int, high: int) -> FrozenSet[int]:
+    # "*", "5", "1-5", "*/15", "10-50/10" и их списки через запятую
+    values = set()
+    for part in field.split(","):
+        expr, _, step = part.partition("/")
+        try:
+            step = int(step) if step else 1
+            if expr == "*":
+                start, end = low, high
+            elif "-" in expr:
+                start, end = (int(x) for x in expr.split("-", 1))
+            else:
+                start = int(expr)
+                end = high if step > 1 else start
+        except ValueError:
+            raise ValueError(f"Не удалось разобрать поле: {part}")
+        if step < 1 or not low <= start <= end <= high:
+            raise ValueError(f"Значение вне диапазона {low}-{high}: {part}")
+        values.update(range(start, end + 1, step))
+    return frozenset(values)
+
+
+# Расписание вида "0 9 * * 1-5" (по будням в 9:00) в локальном времени сервера.
+# Как в классическом cron: если заданы и день месяца, и день недели, хватает совпадения любого
+class CronSchedule:
+    def __init__(self, expression: str):
+        parts = expression.split()
+        if len(parts) != 5:
+            raise ValueError("Нужно 5 полей: минута час день месяц день_недели")
+        fields = [_parse_field(part, low, high) for part, (low, high) in zip(parts, FIELD_RANGES)]
+        self.expression = " ".join(parts)
+        self.minutes, self.hours, self.days, self.months, weekdays = fields
+        self.weekdays = frozenset(day % 7 for day in weekdays)
+        self.any_day = parts[2] == "*"
+        self.any_weekday = parts[4] == "*"
+
+    def __str__(self) -> str:
+        return self.expression
+
+    def _day_matches(self, moment: datetime) -> bool:
+        day_ok = moment.day in self.days
+        weekday_ok = (moment.weekday() + 1) % 7 in self.weekdays
+        if self.any_day:
+            return weekday_ok
+        if self.any_weekday:
+            return day_ok
+        return day_ok or weekday_ok
+
+    def next_after(self, timestamp: float) -> float:
+        # Ближайшее срабатывание строго после timestamp (секунды эпохи)
+        moment = datetime.fromtimestamp(timestamp).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = moment + timedelta(days=MAX_LOOKAHEAD_DAYS)
+        while moment < limit:
+            if moment.month not in self.months:
+                moment = (moment.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return moment.timestamp()
+        raise ValueError(f"Выражение {self.expression} никогда не срабатывает")
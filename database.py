@@ -1,213 +1,479 @@
+import asyncio
+import json
+import queue
 import sqlite3
 import logging
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
-from typing import List, Set, Tuple, Optional
+from typing import Dict, Iterable, List, NamedTuple, Set, Tuple, Optional
+
+# Настройки соединения: WAL + NORMAL убирают fsync на каждый коммит,
+# кэш страниц ~16 МБ, mmap до 128 МБ
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA mmap_size = 134217728",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA busy_timeout = 5000",
+)
+STATEMENT_CACHE_SIZE = 256
+
+# Очистка устаревших строк: размер пачки DELETE, страниц на incremental_vacuum, период запуска
+RETENTION_BATCH_SIZE = 1000
+RETENTION_VACUUM_PAGES = 500
+RETENTION_INTERVAL = 600
+
+
+# Настройки чата — та же строка, что и в таблице chats (совместима с кортежем)
+class ChatSettings(NamedTuple):
+    chat_id: int
+    has_autoposting: int = 1
+    has_autopining: int = 1
+    has_stopwords: int = 1
+    captcha_timeout: int = 300
+    message_cooldown: int = 0
+    captcha_retention: int = 86400
+    rate_limit_count: int = 1
+    is_active: int = 1
+
+
+# Задача автопостинга — строка autopost_jobs; content и keyboard хранятся как JSON
+class AutopostJob(NamedTuple):
+    id: int
+    name: str
+    source_chat_id: Optional[int]
+    source_message_id: Optional[int]
+    content: dict
+    keyboard: Optional[dict]
+    interval_s: float
+    targets: Optional[List[str]]
+    next_run_ms: int
+    cron: Optional[str] = None
+    paused: int = 0
+    target_ids: Optional[List[int]] = None
+
+
+# Колонки chats, которые можно менять через update_chat_settings / bulk_update_chat_settings
+CHAT_SETTING_COLUMNS = frozenset(ChatSettings._fields) - {"chat_id"}
+
+# Кэш настроек чатов на процесс: db_name -> {chat_id: ChatSettings}
+_chat_settings: Dict[str, Dict[int, ChatSettings]] = {}
+
+
+# === Миграции схемы ===
+# Каждая миграция выполняется один раз в своей транзакции; номер версии хранится
+# в PRAGMA user_version. Новые изменения схемы — только новой функцией в конце списка
+def _migration_initial(cursor):
+    # Таблица чатов
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS chats (
+            chat_id INTEGER PRIMARY KEY,
+            has_autoposting INTEGER DEFAULT 1,
+            has_autopining INTEGER DEFAULT 1,
+            has_stopwords INTEGER DEFAULT 1,
+            captcha_timeout INTEGER DEFAULT 300,
+            message_cooldown INTEGER DEFAULT 0
+        )
+    ''')
+    # Таблица стоп-слов
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stop_words (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            word TEXT UNIQUE
+        )
+    ''')
+    # Таблица статуса капчи
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS captcha_status (
+            user_id INTEGER,
+            chat_id INTEGER,
+            passed INTEGER DEFAULT 0,
+            attempts INTEGER DEFAULT 0,
+            message_id INTEGER,
+            PRIMARY KEY (user_id, chat_id)
+        )
+    ''')
+    # Таблица времени последнего сообщения (для кулдауна)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_messages (
+            user_id INTEGER,
+            chat_id INTEGER,
+            last_message_time TEXT,
+            PRIMARY KEY (user_id, chat_id)
+        )
+    ''')
+    # Таблица закреплённых сообщений
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS pinned_messages (
+            message_id INTEGER,
+            chat_id INTEGER,
+            PRIMARY KEY (message_id, chat_id)
+        )
+    ''')
+    # Старые базы без версии: таблицы уже есть, но могут не хватать колонок
+    columns = {row[1] for row in cursor.execute("PRAGMA table_info(chats)")}
+    if "captcha_timeout" not in columns:
+        cursor.execute("ALTER TABLE chats ADD COLUMN captcha_timeout INTEGER DEFAULT 300")
+    if "message_cooldown" not in columns:
+        cursor.execute("ALTER TABLE chats ADD COLUMN message_cooldown INTEGER DEFAULT 0")
+
+
+def _migration_epoch_message_time(cursor):
+    # ISO-строки -> миллисекунды эпохи. WITHOUT ROWID: строка хранится прямо в
+    # B-дереве первичного ключа (chat_id, user_id), так что поиск по паре
+    # покрывается индексом целиком и не ходит в отдельную таблицу
+    rows = cursor.execute("SELECT user_id, chat_id, last_message_time FROM user_messages").fetchall()
+    cursor.execute("DROP TABLE user_messages")
+    cursor.execute('''
+        CREATE TABLE user_messages (
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            last_message_ms INTEGER NOT NULL,
+            PRIMARY KEY (chat_id, user_id)
+        ) WITHOUT ROWID
+    ''')
+    converted = []
+    for user_id, chat_id, last_message_time in rows:
+        try:
+            converted.append((chat_id, user_id, int(datetime.fromisoformat(last_message_time).timestamp() * 1000)))
+        except (TypeError, ValueError):
+            continue
+    cursor.executemany("INSERT OR REPLACE INTO user_messages (chat_id, user_id, last_message_ms) VALUES (?, ?, ?)", converted)
+
+
+def _migration_retention(cursor):
+    # Время создания/изменения статуса капчи и окна хранения на чат (в секундах)
+    now = int(time.time() * 1000)
+    cursor.execute("ALTER TABLE captcha_status ADD COLUMN created_ms INTEGER")
+    cursor.execute("ALTER TABLE captcha_status ADD COLUMN updated_ms INTEGER")
+    cursor.execute("UPDATE captcha_status SET created_ms = ?, updated_ms = ?", (now, now))
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_captcha_status_updated ON captcha_status (passed, updated_ms)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_messages_time ON user_messages (last_message_ms)")
+    cursor.execute("ALTER TABLE chats ADD COLUMN captcha_retention INTEGER DEFAULT 86400")
+    cursor.execute("ALTER TABLE chats ADD COLUMN messages_retention INTEGER DEFAULT 86400")
+
+
+def _migration_rate_limits(cursor):
+    # Лимит "rate_limit_count сообщений за message_cooldown секунд" и снимки состояния лимитера
+    cursor.execute("ALTER TABLE chats ADD COLUMN rate_limit_count INTEGER DEFAULT 1")
+    cursor.execute('''
+        CREATE TABLE rate_limits (
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            tokens REAL NOT NULL,
+            updated_ms INTEGER NOT NULL,
+            full_at_ms INTEGER NOT NULL,
+            PRIMARY KEY (chat_id, user_id)
+        ) WITHOUT ROWID
+    ''')
+
+
+def _migration_drop_user_messages(cursor):
+    # Кулдаун считает лимитер в памяти со снимками в rate_limits — время последнего
+    # сообщения больше не пишется. Столбец chats.messages_retention остаётся без
+    # использования: DROP COLUMN есть только с SQLite 3.35
+    cursor.execute("DROP TABLE IF EXISTS user_messages")
+
+
+def _migration_captcha_deadlines(cursor):
+    # Срок капчи хранится в базе, чтобы таймауты переживали перезапуск.
+    # Частичный индекс — только по ожидающим капчам
+    cursor.execute("ALTER TABLE captcha_status ADD COLUMN deadline_ms INTEGER")
+    cursor.execute("CREATE INDEX idx_captcha_status_deadline ON captcha_status (deadline_ms) WHERE deadline_ms IS NOT NULL")
+
+
+def _migration_autopost_jobs(cursor):
+    # Задачи автопостинга переживают перезапуск. AUTOINCREMENT — номера удалённых задач
+    # не переиспользуются, id в /autoposting_list стабильны
+    cursor.execute('''
+        CREATE TABLE autopost_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            source_chat_id INTEGER,
+            source_message_id INTEGER,
+            content TEXT NOT NULL,
+            keyboard TEXT,
+            interval_s REAL NOT NULL,
+            targets TEXT,
+            next_run_ms INTEGER NOT NULL,
+            created_ms INTEGER NOT NULL
+        )
+    ''')
+
+
+def _migration_autopost_schedule(cursor):
+    # Расписание cron вместо фиксированного интервала и пауза задачи
+    cursor.execute("ALTER TABLE autopost_jobs ADD COLUMN cron TEXT")
+    cursor.execute("ALTER TABLE autopost_jobs ADD COLUMN paused INTEGER NOT NULL DEFAULT 0")
+
+
+def _migration_autopost_target_ids(cursor):
+    # Цели, один раз разрешённые в числовые chat_id (в том же порядке, что и targets)
+    cursor.execute("ALTER TABLE autopost_jobs ADD COLUMN target_ids TEXT")
+
+
+def _migration_chat_health(cursor):
+    # 0 — бот выгнан или чат удалён: рассылки пропускают чат без обращения к API
+    cursor.execute("ALTER TABLE chats ADD COLUMN is_active INTEGER NOT NULL DEFAULT 1")
+
+
+def _migration_pin_campaigns(cursor):
+    # Закрепы группируются по рассылке (кампании) и хранят время — открепление по кампании,
+    # чату или возрасту. Индекс по chat_id — для выборки и удаления закрепов одного чата
+    cursor.execute('''
+        CREATE TABLE pin_campaigns (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            created_ms INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute("ALTER TABLE pinned_messages ADD COLUMN campaign_id INTEGER")
+    cursor.execute("ALTER TABLE pinned_messages ADD COLUMN pinned_ms INTEGER")
+    cursor.execute("CREATE INDEX idx_pinned_messages_chat ON pinned_messages (chat_id)")
+    cursor.execute("CREATE INDEX idx_pinned_messages_campaign ON pinned_messages (campaign_id)")
+
+
+MIGRATIONS = [
+    _migration_initial,
+    _migration_epoch_message_time,
+    _migration_retention,
+    _migration_rate_limits,
+    _migration_drop_user_messages,
+    _migration_captcha_deadlines,
+    _migration_autopost_jobs,
+    _migration_autopost_schedule,
+    _migration_autopost_target_ids,
+    _migration_chat_health,
+    _migration_pin_campaigns,
+]
+
+
+def now_ms() -> int:
+    return int(time.time() * 1000)
 
 
 class MainDb:
     def __init__(self, db_name: str = "bot.db"):
         self.db_name = db_name
-        self.create_tables()
+        # Одно долгоживущее соединение на весь процесс вместо connect() в каждом методе.
+        # check_same_thread=False + RLock — можно вызывать из любого потока
+        self.conn = sqlite3.connect(db_name, check_same_thread=False,
+                                    cached_statements=STATEMENT_CACHE_SIZE)
+        for pragma in PRAGMAS:
+            self.conn.execute(pragma)
+        self._lock = threading.RLock()
+        self.migrate()
+        if db_name not in _chat_settings:
+            _chat_settings[db_name] = self._load_chat_settings()
+        self._chats = _chat_settings[db_name]
 
-    def create_tables(self):
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
-            # Таблица чатов
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS chats (
-                    chat_id INTEGER PRIMARY KEY,
-                    has_autoposting INTEGER DEFAULT 1,
-                    has_autopining INTEGER DEFAULT 1,
-                    has_stopwords INTEGER DEFAULT 1,
-                    captcha_timeout INTEGER DEFAULT 300,
-                    message_cooldown INTEGER DEFAULT 0
-                )
-            ''')
-            # Таблица стоп-слов
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS stop_words (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    word TEXT UNIQUE
-                )
-            ''')
-            # Таблица статуса капчи
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS captcha_status (
-                    user_id INTEGER,
-                    chat_id INTEGER,
-                    passed INTEGER DEFAULT 0,
-                    attempts INTEGER DEFAULT 0,
-                    message_id INTEGER,
-                    PRIMARY KEY (user_id, chat_id)
-                )
-            ''')
-            # Таблица времени последнего сообщения (для кулдауна)
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS user_messages (
-                    user_id INTEGER,
-                    chat_id INTEGER,
-                    last_message_time TEXT,
-                    PRIMARY KEY (user_id, chat_id)
-                )
-            ''')
-            # Таблица закреплённых сообщений
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS pinned_messages (
-                    message_id INTEGER,
-                    chat_id INTEGER,
-                    PRIMARY KEY (message_id, chat_id)
-                )
-            ''')
-            # Безопасное добавление новых колонок (на случай старой базы)
+    @contextmanager
+    def _connect(self):
+        # Выдаём общее соединение под блокировкой: коммит при успехе, откат при ошибке
+        with self._lock:
             try:
-                cursor.execute("ALTER TABLE chats ADD COLUMN captcha_timeout INTEGER DEFAULT 300")
-            except sqlite3.OperationalError:
-                pass
-            try:
-                cursor.execute("ALTER TABLE chats ADD COLUMN message_cooldown INTEGER DEFAULT 0")
-            except sqlite3.OperationalError:
-                pass
-            conn.commit()
-        logging.info("Tables created successfully.")
+                yield self.conn
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+
+    def close(self):
+        with self._lock:
+            self.conn.commit()
+            self.conn.close()
+        logging.info("Database connection closed.")
+
+    def migrate(self):
+        # Применяем по порядку только те миграции, которых ещё нет (номер в PRAGMA user_version)
+        with self._lock:
+            version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+            for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+                with self._connect() as conn:
+                    conn.execute("BEGIN IMMEDIATE")
+                    migration(conn.cursor())
+                    conn.execute(f"PRAGMA user_version = {number}")
+                logging.info(f"Database migrated to version {number} ({migration.__name__})")
+            # incremental_vacuum работает только при auto_vacuum = INCREMENTAL,
+            # для существующей базы режим включается одним полным VACUUM
+            if self.conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                self.conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                self.conn.execute("VACUUM")
+                logging.info("Database switched to incremental auto_vacuum")
 
     def add_chat(self, chat_id: int):
-        with sqlite3.connect(self.db_name) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
+            # Повторный /add_chat снова включает чат, помеченный неактивным
             cursor.execute('''
-                INSERT OR IGNORE INTO chats
+                INSERT INTO chats
                 (chat_id, has_autoposting, has_autopining, has_stopwords, captcha_timeout, message_cooldown)
                 VALUES (?, 1, 1, 1, 300, 0)
+                ON CONFLICT (chat_id) DO UPDATE SET is_active = 1
             ''', (chat_id,))
             conn.commit()
+        self._chats[chat_id] = self._chats.get(chat_id, ChatSettings(chat_id))._replace(is_active=1)
         logging.info(f"Chat {chat_id} added with all features enabled: autoposting=1, autopining=1, stopwords=1, message_cooldown=0")
 
     def update_chat_settings(self, chat_id: int, **kwargs):
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
-            for key, value in kwargs.items():
-                cursor.execute(f"UPDATE chats SET {key} = ? WHERE chat_id = ?", (value, chat_id))
-            conn.commit()
+        self.bulk_update_chat_settings([chat_id], **kwargs)
         logging.info(f"Chat {chat_id} settings updated in database")
 
-    def get_all_chats(self) -> List[Tuple]:
-        with sqlite3.connect(self.db_name) as conn:
+    def bulk_update_chat_settings(self, chat_ids: Optional[Iterable[int]] = None, **kwargs) -> int:
+        # Любой набор настроек для списка чатов (None — все чаты) одним UPDATE в одной транзакции
+        unknown = set(kwargs) - CHAT_SETTING_COLUMNS
+        if unknown:
+            raise ValueError(f"Unknown chat settings: {', '.join(sorted(unknown))}")
+        if not kwargs:
+            return 0
+        assignments = ", ".join(f"{key} = ?" for key in kwargs)
+        with self._connect() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT chat_id, has_autoposting, has_autopining, has_stopwords, captcha_timeout, message_cooldown FROM chats")
-            return cursor.fetchall()
+            if chat_ids is None:
+                cursor.execute(f"UPDATE chats SET {assignments}", tuple(kwargs.values()))
+                targets = list(self._chats)
+            else:
+                targets = list(chat_ids)
+                cursor.execute(f"UPDATE chats SET {assignments} WHERE chat_id IN (SELECT value FROM json_each(?))",
+                               (*kwargs.values(), json.dumps(targets)))
+            updated = cursor.rowcount
+        for chat_id in targets:
+            self._update_cached_chat(chat_id, **kwargs)
+        if chat_ids is None or len(targets) > 1:
+            logging.info(f"Settings {kwargs} updated for {updated} chats")
+        return updated
+
+    def get_all_chats(self) -> List[ChatSettings]:
+        return list(self._chats.values())
+
+    def get_chat(self, chat_id: int) -> Optional[ChatSettings]:
+        return self._chats.get(chat_id)
+
+    def _load_chat_settings(self) -> Dict[int, ChatSettings]:
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT chat_id, has_autoposting, has_autopining, has_stopwords, captcha_timeout, message_cooldown, "
+                           "captcha_retention, rate_limit_count, is_active FROM chats")
+            return {row[0]: ChatSettings(*row) for row in cursor.fetchall()}
+
+    def _update_cached_chat(self, chat_id: int, **kwargs):
+        # Write-through: кэш меняется только после успешной записи в базу
+        settings = self._chats.get(chat_id)
+        if settings:
+            self._chats[chat_id] = settings._replace(**kwargs)
 
     def delete_chat(self, chat_id: int) -> bool:
-        with sqlite3.connect(self.db_name) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM chats WHERE chat_id = ?", (chat_id,))
             deleted = cursor.rowcount > 0
             conn.commit()
+        self._chats.pop(chat_id, None)
         return deleted
 
+    def migrate_chat(self, old_chat_id: int, new_chat_id: int) -> bool:
+        # Группа стала супергруппой: настройки переезжают на новый id.
+        # Если новый id уже в базе — остаётся его строка, старая удаляется
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("UPDATE OR IGNORE chats SET chat_id = ? WHERE chat_id = ?", (new_chat_id, old_chat_id))
+            moved = cursor.rowcount > 0
+            cursor.execute("DELETE FROM chats WHERE chat_id = ?", (old_chat_id,))
+        settings = self._chats.pop(old_chat_id, None)
+        if moved and settings:
+            self._chats[new_chat_id] = settings._replace(chat_id=new_chat_id)
+        return moved
+
     # === Стоп-слова ===
     def update_stop_words(self, words: List[str]):
-        with sqlite3.connect(self.db_name) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM stop_words")
             cursor.executemany("INSERT OR IGNORE INTO stop_words (word) VALUES (?)", [(w,) for w in words])
             conn.commit()
 
     def get_all_stop_words(self) -> Set[str]:
-        with sqlite3.connect(self.db_name) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT word FROM stop_words")
             return {row[0].lower() for row in cursor.fetchall()}
 
     def have_stop_words(self, chat_id: int) -> bool:
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT has_stopwords FROM chats WHERE chat_id = ?", (chat_id,))
-            row = cursor.fetchone()
-            return bool(row[0]) if row else False
+        settings = self._chats.get(chat_id)
+        return bool(settings.has_stopwords) if settings else False
 
     # === Кулдаун сообщений ===
     def set_message_cooldown(self, chat_id: int, seconds: int):
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
-            cursor.execute("UPDATE chats SET message_cooldown = ? WHERE chat_id = ?", (seconds, chat_id))
-            conn.commit()
+        self.bulk_update_chat_settings([chat_id], message_cooldown=seconds)
         logging.info(f"Message cooldown set to {seconds} seconds for chat {chat_id}")
 
     def get_message_cooldown(self, chat_id: int) -> int:
-        try:
-            with sqlite3.connect(self.db_name) as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT message_cooldown FROM chats WHERE chat_id = ?", (chat_id,))
-                row = cursor.fetchone()
-                if row:
-                    return int(row[0])
-                else:
-                    logging.warning(f"Chat {chat_id} not found when getting message_cooldown, returning 0")
-                    return 0
-        except Exception as e:
-            logging.error(f"Error getting message_cooldown for chat {chat_id}: {e}")
-            return 0
+        settings = self._chats.get(chat_id)
+        if settings:
+            return int(settings.message_cooldown)
+        logging.warning(f"Chat {chat_id} not found when getting message_cooldown, returning 0")
+        return 0
 
-    def get_last_message_time(self, user_id: int, chat_id: int) -> Optional[datetime]:
-        try:
-            with sqlite3.connect(self.db_name) as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT last_message_time FROM user_messages WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
-                row = cursor.fetchone()
-                if row and row[0]:
-                    return datetime.fromisoformat(row[0])
-                return None
-        except Exception as e:
-            logging.error(f"Error getting last_message_time: {e}")
-            return None
-
-    def update_last_message_time(self, user_id: int, chat_id: int):
-        now = datetime.now().isoformat()
-        with sqlite3.connect(self.db_name) as conn:
+    # === Снимки лимитера сообщений ===
+    def save_rate_limits(self, rows: List[Tuple[int, int, float, int, int]]):
+        # Снимок целиком заменяет предыдущий
+        with self._connect() as conn:
             cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO user_messages (user_id, chat_id, last_message_time)
-                VALUES (?, ?, ?)
-                ON CONFLICT(user_id, chat_id) DO UPDATE SET last_message_time = excluded.last_message_time
-            ''', (user_id, chat_id, now))
-            conn.commit()
-        logging.info(f"Updated last message time for user {user_id} in chat {chat_id}")
+            cursor.execute("DELETE FROM rate_limits")
+            cursor.executemany(
+                "INSERT INTO rate_limits (chat_id, user_id, tokens, updated_ms, full_at_ms) VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+        logging.debug(f"Rate limiter snapshot saved: {len(rows)} buckets")
+
+    def load_rate_limits(self) -> List[Tuple[int, int, float, int, int]]:
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT chat_id, user_id, tokens, updated_ms, full_at_ms FROM rate_limits WHERE full_at_ms > ?",
+                           (now_ms(),))
+            return cursor.fetchall()
 
     # === Капча ===
     def check_captcha_status(self, user_id: int, chat_id: int) -> bool:
-        with sqlite3.connect(self.db_name) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT passed FROM captcha_status WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
             row = cursor.fetchone()
             return row is not None and row[0] == 1
 
     def update_captcha_status(self, user_id: int, chat_id: int):
-        with sqlite3.connect(self.db_name) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute('''
-                INSERT INTO captcha_status (user_id, chat_id, passed, attempts)
-                VALUES (?, ?, 1, 0)
-                ON CONFLICT(user_id, chat_id) DO UPDATE SET passed = 1, attempts = 0
-            ''', (user_id, chat_id))
+                INSERT INTO captcha_status (user_id, chat_id, passed, attempts, created_ms, updated_ms)
+                VALUES (?, ?, 1, 0, ?, ?)
+                ON CONFLICT(user_id, chat_id) DO UPDATE SET passed = 1, attempts = 0, deadline_ms = NULL,
+                updated_ms = excluded.updated_ms
+            ''', (user_id, chat_id, now_ms(), now_ms()))
             conn.commit()
         logging.info(f"Captcha status updated for user {user_id} in chat {chat_id}")
 
     def delete_captcha_status(self, user_id: int, chat_id: int):
-        with sqlite3.connect(self.db_name) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM captcha_status WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
             conn.commit()
         logging.info(f"Captcha status deleted for user {user_id} in chat {chat_id}")
 
     def increment_captcha_attempts(self, user_id: int, chat_id: int) -> int:
-        with sqlite3.connect(self.db_name) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute('''
-                INSERT INTO captcha_status (user_id, chat_id, attempts, passed)
-                VALUES (?, ?, 1, 0)
+                INSERT INTO captcha_status (user_id, chat_id, attempts, passed, created_ms, updated_ms)
+                VALUES (?, ?, 1, 0, ?, ?)
                 ON CONFLICT(user_id, chat_id) DO UPDATE SET
                 attempts = attempts + 1,
-                passed = 0
-            ''', (user_id, chat_id))
+                passed = 0,
+                updated_ms = excluded.updated_ms
+            ''', (user_id, chat_id, now_ms(), now_ms()))
             cursor.execute("SELECT attempts FROM captcha_status WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
             attempts = cursor.fetchone()[0]
             conn.commit()
@@ -215,85 +481,363 @@ class MainDb:
             return attempts
 
     def reset_captcha_attempts(self, user_id: int, chat_id: int):
-        with sqlite3.connect(self.db_name) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
-            cursor.execute("UPDATE captcha_status SET attempts = 0 WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
+            cursor.execute("UPDATE captcha_status SET attempts = 0, updated_ms = ? WHERE user_id = ? AND chat_id = ?",
+                           (now_ms(), user_id, chat_id))
             conn.commit()
 
     def get_captcha_attempts(self, user_id: int, chat_id: int) -> int:
-        with sqlite3.connect(self.db_name) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT attempts FROM captcha_status WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
             row = cursor.fetchone()
             return row[0] if row else 0
 
     def get_captcha_timeout(self, chat_id: int) -> int:
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT captcha_timeout FROM chats WHERE chat_id = ?", (chat_id,))
-            row = cursor.fetchone()
-            return row[0] if row else 300
+        settings = self._chats.get(chat_id)
+        return settings.captcha_timeout if settings else 300
 
     def set_captcha_timeout(self, chat_id: int, seconds: int):
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
-            cursor.execute("UPDATE chats SET captcha_timeout = ? WHERE chat_id = ?", (seconds, chat_id))
-            conn.commit()
+        self.bulk_update_chat_settings([chat_id], captcha_timeout=seconds)
 
-    def update_captcha_message_id(self, user_id: int, chat_id: int, message_id: int):
-        with sqlite3.connect(self.db_name) as conn:
+    def update_captcha_message_id(self, user_id: int, chat_id: int, message_id: int, deadline_ms: Optional[int] = None):
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute('''
-                INSERT INTO captcha_status (user_id, chat_id, message_id, passed)
-                VALUES (?, ?, ?, 0)
+                INSERT INTO captcha_status (user_id, chat_id, message_id, passed, created_ms, updated_ms, deadline_ms)
+                VALUES (?, ?, ?, 0, ?, ?, ?)
                 ON CONFLICT(user_id, chat_id) DO UPDATE SET
                 message_id = excluded.message_id,
-                passed = 0
-            ''', (user_id, chat_id, message_id))
+                passed = 0,
+                updated_ms = excluded.updated_ms,
+                deadline_ms = excluded.deadline_ms
+            ''', (user_id, chat_id, message_id, now_ms(), now_ms(), deadline_ms))
             conn.commit()
         logging.info(f"Captcha message_id {message_id} updated for user {user_id} in chat {chat_id}")
 
     def get_captcha_message_id(self, user_id: int, chat_id: int) -> Optional[int]:
-        with sqlite3.connect(self.db_name) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT message_id FROM captcha_status WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
             row = cursor.fetchone()
             return row[0] if row else None
 
-    # === Закреплённые сообщения ===
-    def insert_pinned_messages(self, messages: list):
-        with sqlite3.connect(self.db_name) as conn:
+    def pop_expired_captchas(self, before_ms: int) -> List[Tuple[int, int, Optional[int]]]:
+        # Просроченные капчи забираются и удаляются одной транзакцией по частичному индексу срока
+        with self._connect() as conn:
             cursor = conn.cursor()
-            cursor.executemany("INSERT OR IGNORE INTO pinned_messages (message_id, chat_id) VALUES (?, ?)",
-                               [(m.message_id, m.chat.id) for m in messages])
-            conn.commit()
-        logging.info(f"Pinned messages inserted: {[m.message_id for m in messages]}")
+            cursor.execute('''
+                SELECT user_id, chat_id, message_id FROM captcha_status
+                WHERE deadline_ms IS NOT NULL AND deadline_ms <= ?
+            ''', (before_ms,))
+            rows = cursor.fetchall()
+            cursor.execute("DELETE FROM captcha_status WHERE deadline_ms IS NOT NULL AND deadline_ms <= ?", (before_ms,))
+        logging.info(f"Expired captchas taken for recovery: {len(rows)}")
+        return rows
 
-    def add_pinned_message(self, chat_id: int, message_id: int):
-        with sqlite3.connect(self.db_name) as conn:
+    def get_pending_captchas(self) -> List[Tuple[int, int, Optional[int], int]]:
+        # Все ожидающие капчи по возрастанию срока (идёт по частичному индексу).
+        # У пройденных капч deadline_ms сбрасывается в NULL, отдельный фильтр по passed не нужен
+        with self._connect() as conn:
             cursor = conn.cursor()
-            cursor.execute(
-                "INSERT OR IGNORE INTO pinned_messages (message_id, chat_id) VALUES (?, ?)",
-                (message_id, chat_id)
-            )
+            cursor.execute('''
+                SELECT user_id, chat_id, message_id, deadline_ms FROM captcha_status
+                WHERE deadline_ms IS NOT NULL
+                ORDER BY deadline_ms
+            ''')
+            return cursor.fetchall()
+
+    # === Капча пачкой (рейд-режим): одно сообщение на много пользователей ===
+    def add_captcha_batch(self, chat_id: int, message_id: int, user_ids: List[int], deadline_ms: int):
+        ts = now_ms()
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.executemany('''
+                INSERT INTO captcha_status (user_id, chat_id, message_id, passed, attempts, created_ms, updated_ms, deadline_ms)
+                VALUES (?, ?, ?, 0, 0, ?, ?, ?)
+                ON CONFLICT(user_id, chat_id) DO UPDATE SET
+                message_id = excluded.message_id,
+                passed = 0,
+                attempts = 0,
+                updated_ms = excluded.updated_ms,
+                deadline_ms = excluded.deadline_ms
+            ''', [(user_id, chat_id, message_id, ts, ts, deadline_ms) for user_id in user_ids])
             conn.commit()
-        logging.info(f"Добавлено закреплённое сообщение {message_id} в чат {chat_id}")
+        logging.info(f"Captcha batch {message_id} in chat {chat_id}: {len(user_ids)} users")
 
-    def delete_pinned_message(self, chat_id: int, message_id: int):
-        with sqlite3.connect(self.db_name) as conn:
+    def get_batch_captcha_users(self, chat_id: int, message_id: int) -> List[int]:
+        # Непройденные капчи пачки; условие на deadline_ms — чтобы шло по частичному индексу
+        with self._connect() as conn:
             cursor = conn.cursor()
-            cursor.execute(
-                "DELETE FROM pinned_messages WHERE message_id = ? AND chat_id = ?",
-                (message_id, chat_id)
-            )
+            cursor.execute('''
+                SELECT user_id FROM captcha_status
+                WHERE deadline_ms IS NOT NULL AND chat_id = ? AND message_id = ?
+            ''', (chat_id, message_id))
+            return [row[0] for row in cursor.fetchall()]
+
+    def delete_captcha_statuses(self, chat_id: int, user_ids: List[int]):
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.executemany("DELETE FROM captcha_status WHERE user_id = ? AND chat_id = ?",
+                               [(user_id, chat_id) for user_id in user_ids])
             conn.commit()
+        logging.info(f"Captcha statuses deleted for {len(user_ids)} users in chat {chat_id}")
+
+    # === Автопостинг ===
+    def add_autopost_job(self, name: str, source_chat_id: Optional[int], source_message_id: Optional[int],
+                         content: dict, keyboard: Optional[dict], interval_s: float,
+                         targets: Optional[List[str]], next_run_ms: int, cron: Optional[str] = None,
+                         target_ids: Optional[List[int]] = None) -> AutopostJob:
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO autopost_jobs
+                (name, source_chat_id, source_message_id, content, keyboard, interval_s, targets, next_run_ms, cron,
+                target_ids, created_ms)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (name, source_chat_id, source_message_id, json.dumps(content),
+                  json.dumps(keyboard) if keyboard else None, interval_s,
+                  json.dumps(targets) if targets else None, next_run_ms, cron,
+                  json.dumps(target_ids) if target_ids else None, now_ms()))
+            job_id = cursor.lastrowid
+        logging.info(f"Autopost job {job_id} added: {name}")
+        return AutopostJob(job_id, name, source_chat_id, source_message_id, content, keyboard,
+                           interval_s, targets, next_run_ms, cron, 0, target_ids)
+
+    def get_autopost_jobs(self) -> List[AutopostJob]:
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT id, name, source_chat_id, source_message_id, content, keyboard, interval_s, targets, next_run_ms,
+                cron, paused, target_ids
+                FROM autopost_jobs ORDER BY id
+            ''')
+            return [_autopost_job(row) for row in cursor.fetchall()]
+
+    def set_autopost_next_run(self, job_id: int, next_run_ms: int):
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("UPDATE autopost_jobs SET next_run_ms = ? WHERE id = ?", (next_run_ms, job_id))
+
+    def set_autopost_targets(self, job_id: int, targets: Optional[List[str]], target_ids: Optional[List[int]]):
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("UPDATE autopost_jobs SET targets = ?, target_ids = ? WHERE id = ?",
+                           (json.dumps(targets) if targets else None,
+                            json.dumps(target_ids) if target_ids else None, job_id))
+
+    def set_autopost_content(self, job_id: int, content: dict):
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("UPDATE autopost_jobs SET content = ? WHERE id = ?", (json.dumps(content), job_id))
+
+    def set_autopost_paused(self, job_id: int, paused: bool, next_run_ms: Optional[int] = None) -> bool:
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("UPDATE autopost_jobs SET paused = ?, next_run_ms = COALESCE(?, next_run_ms) WHERE id = ?",
+                           (int(paused), next_run_ms, job_id))
+            return cursor.rowcount > 0
+
+    def delete_autopost_job(self, job_id: int) -> bool:
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM autopost_jobs WHERE id = ?", (job_id,))
+            deleted = cursor.rowcount > 0
+        logging.info(f"Autopost job {job_id} deleted: {deleted}")
+        return deleted
+
+    def delete_all_autopost_jobs(self) -> int:
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM autopost_jobs")
+            deleted = cursor.rowcount
+        logging.info(f"All autopost jobs deleted: {deleted}")
+        return deleted
 
-    def get_pinned_messages(self) -> List[Tuple[int, int]]:
-        with sqlite3.connect(self.db_name) as conn:
+    # === Закреплённые сообщения ===
+    def add_pin_campaign(self, name: str) -> int:
+        with self._connect() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT message_id, chat_id FROM pinned_messages")
+            cursor.execute("INSERT INTO pin_campaigns (name, created_ms) VALUES (?, ?)", (name, now_ms()))
+            return cursor.lastrowid
+
+    def get_pin_campaigns(self) -> List[Tuple[int, str, int, int]]:
+        # Кампании, у которых ещё остались закреплённые сообщения: id, название, время, число закрепов
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT c.id, c.name, c.created_ms, COUNT(*) FROM pin_campaigns c
+                JOIN pinned_messages p ON p.campaign_id = c.id
+                GROUP BY c.id ORDER BY c.id
+            ''')
             return cursor.fetchall()
 
-    # === Очистка просроченной капчи ===
-    def cleanup_expired_captchas(self):
-        logging.info("Expired captcha statuses checked and cleaned up.")
\ No newline at end of file
+    def insert_pinned_messages(self, campaign_id: Optional[int], pins: Iterable[Tuple[int, int]]) -> int:
+        # Все закрепы рассылки одной транзакцией; pins — пары (chat_id, message_id)
+        ts = now_ms()
+        rows = [(message_id, chat_id, campaign_id, ts) for chat_id, message_id in pins]
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.executemany("INSERT OR IGNORE INTO pinned_messages (message_id, chat_id, campaign_id, pinned_ms) "
+                               "VALUES (?, ?, ?, ?)", rows)
+        logging.info(f"Pinned messages recorded: {len(rows)} (campaign {campaign_id})")
+        return len(rows)
+
+    def delete_pinned_messages(self, chat_id: int, message_ids: Iterable[int]) -> int:
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.executemany("DELETE FROM pinned_messages WHERE message_id = ? AND chat_id = ?",
+                               [(message_id, chat_id) for message_id in message_ids])
+            return cursor.rowcount
+
+    def get_pinned_messages(self, campaign_id: Optional[int] = None, chat_id: Optional[int] = None,
+                            older_than_ms: Optional[int] = None) -> List[Tuple[int, int]]:
+        # Пары (message_id, chat_id) с необязательными фильтрами; закрепы без времени считаются старыми
+        conditions, params = [], []
+        if campaign_id is not None:
+            conditions.append("campaign_id = ?")
+            params.append(campaign_id)
+        if chat_id is not None:
+            conditions.append("chat_id = ?")
+            params.append(chat_id)
+        if older_than_ms is not None:
+            conditions.append("COALESCE(pinned_ms, 0) < ?")
+            params.append(older_than_ms)
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"SELECT message_id, chat_id FROM pinned_messages{where}", params)
+            return cursor.fetchall()
+
+    # === Очистка устаревших данных ===
+    def _delete_in_batches(self, sql: str, params: tuple, batch_size: int) -> int:
+        # Каждая пачка — отдельная короткая транзакция, чтобы не держать блокировку надолго
+        total = 0
+        while True:
+            with self._connect() as conn:
+                deleted = conn.execute(sql, params + (batch_size,)).rowcount
+            total += deleted
+            if deleted < batch_size:
+                return total
+
+    def cleanup_expired_captchas(self, batch_size: int = RETENTION_BATCH_SIZE) -> int:
+        # Непройденные капчи, которые не менялись (и срок которых истёк) дольше окна хранения чата.
+        # Пройденные не трогаем — иначе пользователю снова придётся проходить капчу
+        deleted = self._delete_in_batches('''
+            DELETE FROM captcha_status WHERE rowid IN (
+                SELECT cs.rowid FROM captcha_status cs
+                LEFT JOIN chats c ON c.chat_id = cs.chat_id
+                WHERE cs.passed = 0
+                AND MAX(COALESCE(cs.updated_ms, 0), COALESCE(cs.deadline_ms, 0)) < ? - COALESCE(c.captcha_retention, ?) * 1000
+                LIMIT ?
+            )
+        ''', (now_ms(), ChatSettings._field_defaults["captcha_retention"]), batch_size)
+        logging.info(f"Expired captcha statuses cleaned up: {deleted}")
+        return deleted
+
+    def incremental_vacuum(self, pages: int = RETENTION_VACUUM_PAGES) -> int:
+        with self._lock:
+            freelist = self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+            self.conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+            return freelist - self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+    def run_retention(self, batch_size: int = RETENTION_BATCH_SIZE) -> Dict[str, int]:
+        report = {
+            "captcha_status": self.cleanup_expired_captchas(batch_size),
+            "vacuum_pages": self.incremental_vacuum(),
+        }
+        logging.info(f"Retention run finished: {report}")
+        return report
+
+
+# === Асинхронная обёртка ===
+# Эти методы читают только кэш в памяти — их незачем гонять через поток БД
+INLINE_METHODS = {"get_chat", "get_all_chats", "have_stop_words", "get_message_cooldown", "get_captcha_timeout"}
+
+
+class AsyncMainDb:
+    # Все вызовы MainDb выполняются в отдельном потоке БД, event loop их только ждёт.
+    # Очередь ограничена: при переполнении корутины ждут свободного места
+    def __init__(self, db: Optional[MainDb] = None, queue_size: int = 1000):
+        self.sync = db or MainDb()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._queue_size = queue_size
+        self._slots = None
+        self._thread = threading.Thread(target=self._worker, name="db-worker", daemon=True)
+        self._thread.start()
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            loop, future, func, args, kwargs = item
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                loop.call_soon_threadsafe(_resolve_future, future, None, e)
+            else:
+                loop.call_soon_threadsafe(_resolve_future, future, result, None)
+
+    async def _run(self, func, *args, **kwargs):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self._queue_size)
+        async with self._slots:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self._queue.put_nowait((loop, future, func, args, kwargs))
+            return await future
+
+    def __getattr__(self, name):
+        func = getattr(self.sync, name)
+        if not callable(func):
+            return func
+
+        if name in INLINE_METHODS:
+            async def call(*args, **kwargs):
+                return func(*args, **kwargs)
+            call.__name__ = name
+            return call
+
+        async def call(*args, **kwargs):
+            return await self._run(func, *args, **kwargs)
+
+        call.__name__ = name
+        return call
+
+    async def run_retention_job(self, interval: float = RETENTION_INTERVAL):
+        # Фоновая очистка captcha_status
+        while True:
+            try:
+                await self._run(self.sync.run_retention)
+            except Exception as e:
+                logging.error(f"Retention run failed: {e}")
+            await asyncio.sleep(interval)
+
+    async def close(self):
+        await self._run(self.sync.close)
+        self._queue.put(None)
+        self._thread.join()
+
+
+def _autopost_job(row: tuple) -> AutopostJob:
+    (job_id, name, source_chat_id, source_message_id, content, keyboard, interval_s, targets, next_run_ms,
+     cron, paused, target_ids) = row
+    return AutopostJob(job_id, name, source_chat_id, source_message_id, json.loads(content),
+                       json.loads(keyboard) if keyboard else None, interval_s,
+                       json.loads(targets) if targets else None, next_run_ms, cron, paused,
+                       json.loads(target_ids) if target_ids else None)
+
+
+def _resolve_future(future, result, error):
+    if future.cancelled():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+# Общий объект базы на весь процесс: создаётся один раз, миграции выполняются один раз
+db = AsyncMainDb()
@@ -0,0 +1,159 @@
+import asyncio
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from aiogram import types
+from aiogram.utils.exceptions import BadRequest
+
+# Сколько ждать остальные сообщения альбома после первого
+ALBUM_WAIT = 1.0
+# Типы, которые можно отправить заново по file_id, если исходное сообщение недоступно для copy_message
+FILE_TYPES = ("photo", "video", "animation", "document", "audio", "voice", "sticker", "video_note")
+CAPTION_TYPES = ("photo", "video", "animation", "document", "audio", "voice")
+ALBUM_TYPES = ("photo", "video", "document", "audio")
+# Текст ошибки copy_message, когда удалено исходное сообщение. Ошибки целевого чата
+# ("chat not found", 403) сюда не относятся — их разбирает chat_health
+SOURCE_MISSING_ERROR = "message to copy not found"
+
+# Части альбомов, которые ещё собираются: media_group_id -> сообщения
+_albums: Dict[str, List[types.Message]] = {}
+
+
+def _entities(entities) -> list:
+    return [entity.to_python() for entity in entities or []]
+
+
+def _file_id(message: types.Message, kind: str) -> str:
+    media = getattr(message, kind)
+    return media[-1].file_id if kind == "photo" else media.file_id
+
+
+def _fallback(message: types.Message) -> Optional[Tuple[str, dict]]:
+    # Отправка по file_id/тексту: запасной путь, когда copy_message не находит исходник
+    if message.text:
+        return "send_message", {"text": message.text, "entities": _entities(message.entities)}
+    kind = message.content_type
+    if kind not in FILE_TYPES:
+        return None
+    payload = {kind: _file_id(message, kind)}
+    if kind in CAPTION_TYPES and message.caption:
+        payload["caption"] = message.caption
+        payload["caption_entities"] = _entities(message.caption_entities)
+    return f"send_{kind}", payload
+
+
+def _input_media(message: types.Message) -> Optional[dict]:
+    kind = message.content_type
+    if kind not in ALBUM_TYPES:
+        return None
+    media = {"type": kind, "media": _file_id(message, kind)}
+    if message.caption:
+        media["caption"] = message.caption
+        media["caption_entities"] = _entities(message.caption_entities)
+    return media
+
+
+def _call_kwargs(method: str, payload: dict) -> dict:
+    # Объекты для вызова строятся один раз на черновик, а не на каждый чат
+    kwargs = dict(payload)
+    if method == "send_media_group":
+        kwargs["media"] = types.MediaGroup(payload["media"])
+    return kwargs
+
+
+# Черновик поста: готовые аргументы одного вызова Bot API без chat_id.
+# Обычное сообщение — copy_message из исходного чата (любой тип, подписи и entities
+# сохраняются), альбом — send_media_group по file_id. Рассылка — один вызов на чат
+# без разбора типа содержимого
+class PostDraft:
+    def __init__(self, name: str, method: str, payload: dict, fallback: Optional[Tuple[str, dict]] = None):
+        self.name = name
+        self.method = method
+        self.payload = payload
+        self.fallback = fallback
+        self._kwargs = _call_kwargs(method, payload)
+        self._fallback_kwargs = _call_kwargs(*fallback) if fallback else None
+
+    @classmethod
+    def from_messages(cls, messages: List[types.Message],
+                      keyboard: Optional[types.InlineKeyboardMarkup] = None) -> "PostDraft":
+        first = messages[0]
+        name = next((m.text or m.caption for m in messages if m.text or m.caption), "Пост")[:20]
+        if len(messages) > 1:
+            media = [item for item in map(_input_media, messages) if item]
+            draft = cls(name, "send_media_group", {"media": media})
+        else:
+            draft = cls(name, "copy_message", {"from_chat_id": first.chat.id, "message_id": first.message_id},
+                        _fallback(first))
+        draft.bind_keyboard(keyboard)
+        return draft
+
+    @classmethod
+    def from_dict(cls, data: dict, keyboard: Optional[dict] = None) -> "PostDraft":
+        if "method" not in data:
+            draft = cls._from_legacy(data)
+        else:
+            fallback = tuple(data["fallback"]) if data.get("fallback") else None
+            draft = cls(data["name"], data["method"], data["payload"], fallback)
+        draft.bind_keyboard(types.InlineKeyboardMarkup.to_object(keyboard) if keyboard else None)
+        return draft
+
+    @classmethod
+    def _from_legacy(cls, content: dict) -> "PostDraft":
+        # Задачи, сохранённые до появления черновиков: {"type", "file_id", "text", "entities"}
+        name = (content.get("text") or "Пост")[:20]
+        if content["type"] == "text":
+            return cls(name, "send_message", {"text": content["text"], "entities": content["entities"]})
+        payload = {content["type"]: content["file_id"], "caption": content["text"],
+                   "caption_entities": content["entities"]}
+        return cls(name, f"send_{content['type']}", payload)
+
+    def to_dict(self) -> dict:
+        return {"name": self.name, "method": self.method, "payload": self.payload,
+                "fallback": list(self.fallback) if self.fallback else None}
+
+    def bind_keyboard(self, keyboard: Optional[types.InlineKeyboardMarkup]):
+        if keyboard is None:
+            return
+        if self.method == "send_media_group":
+            # Альбомы не поддерживают reply_markup в Bot API
+            logging.warning(f"Кнопки к альбому «{self.name}» не прикрепляются")
+            return
+        self._kwargs["reply_markup"] = keyboard
+        if self._fallback_kwargs is not None:
+            self._fallback_kwargs["reply_markup"] = keyboard
+
+    async def send(self, bot, chat_id):
+        method, kwargs = self.method, self._kwargs
+        try:
+            return await getattr(bot, method)(chat_id, **kwargs)
+        except BadRequest as e:
+            # Исходное сообщение удалено — дальше шлём по file_id; ошибка одного чата черновик не меняет
+            if method != "copy_message" or not self.fallback or SOURCE_MISSING_ERROR not in str(e).lower():
+                raise
+            if self.method == "copy_message":
+                logging.warning(f"Исходник черновика «{self.name}» недоступен ({e}), переход на {self.fallback[0]}")
+                self.method, self.payload = self.fallback
+                self._kwargs = self._fallback_kwargs
+            return await getattr(bot, self.method)(chat_id, **self._kwargs)
+
+
+# id первого отправленного сообщения: copy_message возвращает MessageId, альбом — список
+def first_message_id(result) -> int:
+    if isinstance(result, list):
+        return result[0].message_id
+    return result.message_id
+
+
+async def collect_messages(message: types.Message) -> Optional[List[types.Message]]:
+    # Альбом приходит отдельными сообщениями с общим media_group_id:
+    # первое ждёт остальные и возвращает весь альбом, остальные — None
+    group = message.media_group_id
+    if not group:
+        return [message]
+    if group in _albums:
+        _albums[group].append(message)
+        return None
+    _albums[group] = [message]
+    await asyncio.sleep(ALBUM_WAIT)
+    return sorted(_albums.pop(group), key=lambda m: m.message_id)
@@ -4,11 +4,17 @@ import re
 from aiogram import types
 from aiogram.dispatcher import FSMContext
 
-from config import ADMINS_ID
-import database
-from utils import send_captcha, lift_restrictions, check_bot_permissions
-
-db = database.MainDb()
+from cache import bot_rights_cache, member_cache
+from scheduler import scheduler, action_queue
+from raid import raid_guard
+from chat_health import chat_health
+from handlers.autoposting import autopost_scheduler
+from config import ADMINS_ID, MODE
+from database import db
+import stopwords
+from webhook import update_queue
+from utils import send_captcha, lift_restrictions, check_bot_permissions, lift_stats, missing_bot_rights, \
+    percentile
 
 
 # ===================== Добавление чата =====================
@@ -28,7 +34,7 @@ async def add_chat(message: types.Message):
         return
 
     try:
-        db.add_chat(message.chat.id)
+        await db.add_chat(message.chat.id)
         logging.info(f"Чат {message.chat.id} успешно добавлен в базу")
         await message.answer(
             "Чат успешно добавлен. Все функции (закреп, автопостинг, капча, стоп-слова) включены.\n"
@@ -45,7 +51,7 @@ async def reset_captcha(message: types.Message):
         return
     try:
         user_id = int(message.text.split()[1])
-        db.delete_captcha_status(user_id, message.chat.id)
+        await db.delete_captcha_status(user_id, message.chat.id)
         await message.answer(f"Капча сброшена для {user_id}")
     except:
         await message.answer("Укажите ID: /reset_captcha <user_id>")
@@ -56,7 +62,7 @@ async def reset_captcha_attempts(message: types.Message):
         return
     try:
         user_id = int(message.text.split()[1])
-        db.reset_captcha_attempts(user_id, message.chat.id)
+        await db.reset_captcha_attempts(user_id, message.chat.id)
         await message.answer(f"Попытки сброшены для {user_id}")
     except:
         await message.answer("Укажите ID: /reset_captcha_attempts <user_id>")
@@ -79,9 +85,9 @@ async def check_user(message: types.Message):
     try:
         user_id = int(message.text.split()[1])
         member = await message.bot.get_chat_member(message.chat.id, user_id)
-        captcha_status = db.check_captcha_status(user_id, message.chat.id)
-        attempts = db.get_captcha_attempts(user_id, message.chat.id)
-        cooldown = db.get_message_cooldown(message.chat.id)
+        captcha_status = await db.check_captcha_status(user_id, message.chat.id)
+        attempts = await db.get_captcha_attempts(user_id, message.chat.id)
+        cooldown = await db.get_message_cooldown(message.chat.id)
         text = f"Пользователь {user_id}\nСтатус: {member.status}\nКапча: {'пройдена' if captcha_status else 'не пройдена'}\nПопыток: {attempts}\nКулдаун чата: {cooldown} сек"
         await message.answer(text)
     except:
@@ -105,42 +111,102 @@ async def unrestrict_user(message: types.Message):
 async def debug_chats(message: types.Message):
     if message.from_user.id not in ADMINS_ID:
         return
-    chats = db.get_all_chats()
+    chats = await db.get_all_chats()
     text = "Чаты в базе:\n"
     for c in chats:
-        text += f"ID: {c[0]} | стоп-слова: {c[3]} | автопост: {c[1]} | закреп: {c[2]}\n"
+        text += f"ID: {c[0]} | стоп-слова: {c[3]} | автопост: {c[1]} | закреп: {c[2]} | активен: {c.is_active} | " \
+                f"права: {_format_bot_rights(c.chat_id)}\n"
     await message.answer(text or "Нет чатов")
 
 
+# Права бота из реестра, без обращения к API: ещё не проверялись — "?"
+def _format_bot_rights(chat_id: int) -> str:
+    member = bot_rights_cache.get(chat_id)
+    if member is None:
+        return "?"
+    if member is False:
+        return "ошибка проверки"
+    missing = missing_bot_rights(member)
+    return "ок" if not missing else f"{member.status}, нет {', '.join(missing)}"
+
+
+async def bot_stats(message: types.Message):
+    if message.from_user.id not in ADMINS_ID:
+        return
+    members = member_cache.stats()
+    rights = bot_rights_cache.stats()
+    raids = raid_guard.stats()
+    health = await chat_health.stats()
+    text = (
+        "Статистика бота:\n"
+        f"Кэш статусов участников: {members['size']} записей, "
+        f"попаданий {members['hits']}, промахов {members['misses']}\n"
+        f"Права бота: {rights['size']} чатов, попаданий {rights['hits']}, промахов {rights['misses']}\n"
+        f"Отложенных действий в очереди: {scheduler.depth} "
+        f"(выполнено {scheduler.executed}, ошибок {scheduler.failed})\n"
+        f"Задач автопостинга в расписании: {autopost_scheduler.depth} "
+        f"(запусков {autopost_scheduler.executed}, ошибок {autopost_scheduler.failed})\n"
+        f"Снятие ограничений: успешно {lift_stats.lifted}, ошибок {lift_stats.failed}, "
+        f"повторов {lift_stats.retries}; подтверждено {lift_stats.confirmed}, "
+        f"без подтверждения {lift_stats.unconfirmed}\n"
+        f"Задержка вызова p50/p95: {percentile(lift_stats.call_latencies, 0.5):.2f}/"
+        f"{percentile(lift_stats.call_latencies, 0.95):.2f} с, "
+        f"до подтверждения p50/p95: {percentile(lift_stats.confirm_latencies, 0.5):.2f}/"
+        f"{percentile(lift_stats.confirm_latencies, 0.95):.2f} с\n"
+        f"Рейд-режим: активен в {raids['active']} чатах, всего рейдов {raids['raids']}, "
+        f"участников {raids['users']}, общих капч {raids['messages']}, правок {raids['edits']}\n"
+        f"Очередь действий: в ожидании {len(action_queue)}, выполнено {action_queue.executed}, "
+        f"объединено {action_queue.coalesced}, ошибок {action_queue.failed}\n"
+        f"Чаты: неактивных {health['inactive']}, отключено {health['deactivated']}, "
+        f"возвращено {health['reactivated']}, миграций {health['migrated']}, "
+        f"пропущено при рассылках {health['skipped']}\n"
+    )
+    if MODE == "webhook":
+        updates = update_queue.stats()
+        text += (f"Очередь обновлений: {updates['depth']}, обработано {updates['handled']}, "
+                 f"ошибок {updates['failed']}, отклонено {updates['rejected']}; "
+                 f"задержка p50/p99: {updates['p50'] * 1000:.0f}/{updates['p99'] * 1000:.0f} мс\n")
+    await message.answer(text)
+
+
 # ===================== Включение/выключение функций =====================
+# /turn_on_... --all — сразу во всех чатах одним запросом (только для админов)
+async def toggle_feature(message: types.Message, **settings):
+    if message.get_args().strip() == "--all" and message.from_user.id in ADMINS_ID:
+        await db.bulk_update_chat_settings(None, **settings)
+        return True
+    await db.update_chat_settings(message.chat.id, **settings)
+    return False
+
+
 async def turn_on_stopwords(message: types.Message):
-    db.update_chat_settings(message.chat.id, has_stopwords=1)
-    await message.answer("Стоп-слова и капча включены")
+    everywhere = await toggle_feature(message, has_stopwords=1)
+    await message.answer("Стоп-слова и капча включены" + (" во всех чатах" if everywhere else ""))
 
 
 async def turn_off_stopwords(message: types.Message):
-    db.update_chat_settings(message.chat.id, has_stopwords=0)
-    await message.answer("Стоп-слова и капча выключены")
+    everywhere = await toggle_feature(message, has_stopwords=0)
+    await message.answer("Стоп-слова и капча выключены" + (" во всех чатах" if everywhere else ""))
 
 
 async def turn_on_pinning(message: types.Message):
-    db.update_chat_settings(message.chat.id, has_autopining=1)
-    await message.answer("Закрепление включено")
+    everywhere = await toggle_feature(message, has_autopining=1)
+    await message.answer("Закрепление включено" + (" во всех чатах" if everywhere else ""))
 
 
 async def turn_off_pinning(message: types.Message):
-    db.update_chat_settings(message.chat.id, has_autopining=0)
-    await message.answer("Закрепление выключено")
+    everywhere = await toggle_feature(message, has_autopining=0)
+    await message.answer("Закрепление выключено" + (" во всех чатах" if everywhere else ""))
 
 
 async def turn_on_autoposting(message: types.Message):
-    db.update_chat_settings(message.chat.id, has_autoposting=1)
-    await message.answer("Автопостинг включён")
+    everywhere = await toggle_feature(message, has_autoposting=1)
+    await message.answer("Автопостинг включён" + (" во всех чатах" if everywhere else ""))
 
 
 async def turn_off_autoposting(message: types.Message):
-    db.update_chat_settings(message.chat.id, has_autoposting=0)
-    await message.answer("Автопостинг выключен")
+    everywhere = await toggle_feature(message, has_autoposting=0)
+    await message.answer("Автопостинг выключен" + (" во всех чатах" if everywhere else ""))
 
 
 # ===================== Настройки времени =====================
@@ -154,19 +220,43 @@ async def set_message_cooldown(message: types.Message):
             await message.answer("0–86400 секунд")
             return
         if len(args) > 2 and args[2] == "--all":
-            for chat in db.get_all_chats():
-                db.set_message_cooldown(chat[0], seconds)
+            await db.bulk_update_chat_settings(None, message_cooldown=seconds)
             await message.answer(f"Кулдаун {seconds} сек для всех чатов")
         else:
-            db.set_message_cooldown(message.chat.id, seconds)
+            await db.set_message_cooldown(message.chat.id, seconds)
             await message.answer(f"Кулдаун {seconds} сек для этого чата")
     except:
         await message.answer("Использование: /set_message_cooldown <секунды> [--all]")
 
 
 async def get_message_cooldown(message: types.Message):
-    cooldown = db.get_message_cooldown(message.chat.id)
-    await message.answer(f"Текущий кулдаун: {cooldown} сек")
+    settings = await db.get_chat(message.chat.id)
+    if settings and settings.rate_limit_count > 1:
+        await message.answer(f"Текущий лимит: {settings.rate_limit_count} сообщений за {settings.message_cooldown} сек")
+    else:
+        cooldown = await db.get_message_cooldown(message.chat.id)
+        await message.answer(f"Текущий кулдаун: {cooldown} сек")
+
+
+async def set_rate_limit(message: types.Message):
+    if message.from_user.id not in ADMINS_ID:
+        return
+    try:
+        args = message.text.split()
+        count = int(args[1])
+        seconds = int(args[2])
+        if not 1 <= count <= 100 or not 0 <= seconds <= 86400:
+            await message.answer("1–100 сообщений, 0–86400 секунд")
+            return
+        settings = dict(rate_limit_count=count, message_cooldown=seconds)
+        if len(args) > 3 and args[3] == "--all":
+            await db.bulk_update_chat_settings(None, **settings)
+            await message.answer(f"Лимит {count} сообщений за {seconds} сек для всех чатов")
+        else:
+            await db.update_chat_settings(message.chat.id, **settings)
+            await message.answer(f"Лимит {count} сообщений за {seconds} сек для этого чата")
+    except:
+        await message.answer("Использование: /set_rate_limit <сообщений> <секунды> [--all]")
 
 
 async def set_captcha_timeout(message: types.Message):
@@ -177,16 +267,31 @@ async def set_captcha_timeout(message: types.Message):
         if not 60 <= timeout <= 3600:
             await message.answer("60–3600 секунд")
             return
-        db.set_captcha_timeout(message.chat.id, timeout)
+        await db.set_captcha_timeout(message.chat.id, timeout)
         await message.answer(f"Таймаут капчи: {timeout} сек")
     except:
         await message.answer("Укажите секунды: /set_captcha_timeout <seconds>")
 
 
+async def set_retention(message: types.Message):
+    if message.from_user.id not in ADMINS_ID:
+        return
+    try:
+        args = message.text.split()
+        captcha_retention = int(args[1])
+        if not 60 <= captcha_retention <= 2592000:
+            await message.answer("60–2592000 секунд")
+            return
+        await db.update_chat_settings(message.chat.id, captcha_retention=captcha_retention)
+        await message.answer(f"Хранение капчи: {captcha_retention} сек")
+    except:
+        await message.answer("Использование: /set_retention <капча_сек>")
+
+
 # ===================== Удаление чата =====================
 async def delete_chat(message: types.Message):
     if message.from_user.id in ADMINS_ID:
-        if db.delete_chat(message.chat.id):
+        if await db.delete_chat(message.chat.id):
             await message.answer("Чат удалён из базы")
         else:
             await message.answer("Чата нет в базе")
@@ -205,7 +310,8 @@ async def handle_document(message: types.Message):
             content = f.read()
 
         words = [w.strip().lower() for w in content.split(",") if w.strip()]
-        db.update_stop_words(words)
+        await db.update_stop_words(words)
+        await stopwords.reload_stop_words(words)
         await message.answer(f"Обновлено стоп-слов: {len(words)}")
     except Exception as e:
         logging.error(f"Ошибка загрузки стоп-слов: {e}")
@@ -221,6 +327,7 @@ def register_admin_handlers(dp):
     dp.register_message_handler(check_user, commands=["check_user"])
     dp.register_message_handler(unrestrict_user, commands=["unrestrict_user"])
     dp.register_message_handler(debug_chats, commands=["debug_chats"])
+    dp.register_message_handler(bot_stats, commands=["bot_stats"])
     dp.register_message_handler(turn_on_stopwords, commands=["turn_on_stopwords"], chat_type=[types.ChatType.GROUP, types.ChatType.SUPERGROUP])
     dp.register_message_handler(turn_off_stopwords, commands=["turn_off_stopwords"], chat_type=[types.ChatType.GROUP, types.ChatType.SUPERGROUP])
     dp.register_message_handler(turn_on_pinning, commands=["turn_on_pinning"], chat_type=[types.ChatType.GROUP, types.ChatType.SUPERGROUP])
@@ -229,6 +336,8 @@ def register_admin_handlers(dp):
     dp.register_message_handler(turn_off_autoposting, commands=["turn_off_autoposting"], chat_type=[types.ChatType.GROUP, types.ChatType.SUPERGROUP])
     dp.register_message_handler(set_message_cooldown, commands=["set_message_cooldown"])
     dp.register_message_handler(get_message_cooldown, commands=["get_message_cooldown"])
+    dp.register_message_handler(set_rate_limit, commands=["set_rate_limit"])
     dp.register_message_handler(set_captcha_timeout, commands=["set_captcha_timeout"])
+    dp.register_message_handler(set_retention, commands=["set_retention"])
     dp.register_message_handler(delete_chat, commands=["delete_chat"])
     dp.register_message_handler(handle_document, content_types=types.ContentType.DOCUMENT)
\ No newline at end of file
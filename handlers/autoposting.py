@@ -1,17 +1,31 @@
-import asyncio
 import logging
 import re
+import time
+from datetime import datetime
+from typing import Dict, List, Tuple
 
 from aiogram import types
 from aiogram.dispatcher import FSMContext
-
-import database
+from aiogram.utils.exceptions import ChatNotFound, MigrateToChat, TelegramAPIError
+
+from broadcast import broadcaster
+from cache import chat_id_cache
+from chat_health import chat_health
+from cron import CronSchedule
+from database import db, AutopostJob
+from drafts import PostDraft, collect_messages
 from pin_states import PinStates
 import keyboards
+from scheduler import Scheduler
 from utils import check_bot_permissions
 
-db = database.MainDb()
-tasks = []  # глобальный список задач автопостинга
+# Одна куча по времени следующего запуска на все задачи автопостинга вместо
+# задачи со sleep на каждую. Отдельный экземпляр, чтобы долгие рассылки
+# не занимали слоты удалений и банов общего планировщика
+AUTOPOST_CONCURRENT_JOBS = 10
+autopost_scheduler = Scheduler(max_concurrent=AUTOPOST_CONCURRENT_JOBS)
+# Загруженные задачи: id в базе -> строка autopost_jobs
+jobs: Dict[int, AutopostJob] = {}
 
 
 # ===================== Начало автопостинга =====================
@@ -22,42 +36,54 @@ async def joined_autoposting(message: types.Message):
 
 # ===================== Получаем сообщение =====================
 async def got_message_autoposting(message: types.Message, state: FSMContext):
-    await state.update_data(message=message, autoposting=True)
+    messages = await collect_messages(message)
+    if messages is None:
+        return
+    await state.update_data(message=messages[0], messages=messages, autoposting=True)
     await PinStates.choose_action.set()
     await message.answer("Выберите действие", reply_markup=keyboards.in_autoposting())
 
 
 # ===================== Список автопостингов =====================
+# Список читается из базы: номера — id задач, не меняются после удаления других задач и перезапуска
 async def autoposting_list(message: types.Message):
-    global tasks
     args = message.text.split()
     if len(args) > 1:
         try:
-            num = int(args[1]) - 1
-            if 0 <= num < len(tasks):
-                tasks[num].cancel()
-                tasks.pop(num)
-                await message.answer("Задача автопостинга удалена.")
-                return
-        except:
-            pass
-
-    text = "/autoposting_list номер — удалить задачу\n\nАктивные задачи:\n"
-    if not tasks:
+            job_id = int(args[1])
+        except ValueError:
+            job_id = None
+        if job_id is not None and await stop_job(job_id):
+            await message.answer("Задача автопостинга удалена.")
+            return
+
+    rows = await db.get_autopost_jobs()
+    text = ("/autoposting_list номер — удалить задачу\n"
+            "/autoposting_pause номер, /autoposting_resume номер — пауза и продолжение\n\nАктивные задачи:\n")
+    if not rows:
         text += "Нет активных задач."
     else:
-        for i, task in enumerate(tasks, 1):
-            name = task.get_name() if hasattr(task, 'get_name') and task.get_name() else "Без имени"
-            text += f"[{i}] {name}\n"
+        for job in rows:
+            if job.paused:
+                status = "на паузе"
+            else:
+                status = "следующий запуск " + datetime.fromtimestamp(job.next_run_ms / 1000).strftime("%d.%m %H:%M")
+            text += f"[{job.id}] {job.name} — {_format_schedule(job)}, {status}\n"
     await message.answer(text)
 
 
+def _format_schedule(job: AutopostJob) -> str:
+    if job.cron:
+        return f"cron «{job.cron}»"
+    if job.interval_s < 3600:
+        return f"каждые {int(job.interval_s // 60)} мин."
+    return f"каждые {job.interval_s / 3600:g} ч."
+
+
 # ===================== Удаление последнего автопостинга =====================
 async def autoposting_del(message: types.Message):
-    global tasks
-    if tasks:
-        tasks[-1].cancel()
-        tasks.pop(-1)
+    if jobs:
+        await stop_job(max(jobs))
         await message.answer("Последняя задача автопостинга отменена.")
     else:
         await message.answer("Нет задач для отмены.")
@@ -65,39 +91,124 @@ async def autoposting_del(message: types.Message):
 
 # ===================== Выключение всех автопостингов =====================
 async def autoposting_off(message: types.Message):
-    global tasks
-    while tasks:
-        task = tasks.pop(0)
-        task.cancel()
+    for job_id in jobs:
+        autopost_scheduler.cancel(("autopost", job_id))
+    jobs.clear()
+    await db.delete_all_autopost_jobs()
     await message.answer("Все задачи автопостинга отключены.")
 
 
+# ===================== Пауза и продолжение =====================
+async def autoposting_pause(message: types.Message):
+    job = jobs.get(_job_id_arg(message))
+    if job is None:
+        await message.answer("Укажите номер задачи: /autoposting_pause номер")
+        return
+    autopost_scheduler.cancel(("autopost", job.id))
+    jobs[job.id] = job._replace(paused=1)
+    await db.set_autopost_paused(job.id, True)
+    await message.answer(f"Задача {job.id} поставлена на паузу.")
+
+
+async def autoposting_resume(message: types.Message):
+    job = jobs.get(_job_id_arg(message))
+    if job is None or not job.paused:
+        await message.answer("Укажите номер задачи на паузе: /autoposting_resume номер")
+        return
+    job = job._replace(paused=0, next_run_ms=int(next_run_after(job, time.time()) * 1000))
+    jobs[job.id] = job
+    await db.set_autopost_paused(job.id, False, job.next_run_ms)
+    schedule_job(message.bot, job)
+    await message.answer(f"Задача {job.id} продолжена.")
+
+
+def _job_id_arg(message: types.Message):
+    try:
+        return int(message.get_args().strip())
+    except ValueError:
+        return None
+
+
+async def stop_job(job_id: int) -> bool:
+    autopost_scheduler.cancel(("autopost", job_id))
+    jobs.pop(job_id, None)
+    return await db.delete_autopost_job(job_id)
+
+
 # ===================== Запуск автопостинга =====================
 async def start_autoposting(call: types.CallbackQuery, state: FSMContext):
-    global tasks
     data = await state.get_data()
-    message = data.get('message')
+    messages = data.get('messages')
     keyboard = data.get('keyboard')
     interval = data.get('interval')
-    chates = data.get('chates')
+    cron = data.get('cron')
 
-    if not interval:
+    if not interval and not cron:
         await call.answer("Сначала выберите интервал!", show_alert=True)
         return
 
-    name = (message.text or message.caption or "Автопостинг")[:20]
-    task = asyncio.create_task(scheduled_sender(data))
-    task.set_name(name)
-    tasks.append(task)
-
-    await call.message.edit_text(f"Автопостинг запущен с интервалом {interval} ч.")
+    draft = PostDraft.from_messages(messages)
+    # Интервальная задача отправляется сразу, cron — в ближайшее время по расписанию
+    next_run = CronSchedule(cron).next_after(time.time()) if cron else time.time()
+    job = await db.add_autopost_job(
+        draft.name, messages[0].chat.id, messages[0].message_id, draft.to_dict(),
+        keyboard.to_python() if keyboard else None, (interval or 0) * 3600,
+        data.get('targets'), int(next_run * 1000), cron, data.get('target_ids')
+    )
+    schedule_job(call.bot, job)
+
+    await call.message.edit_text(f"Автопостинг запущен: {_format_schedule(job)} (задача {job.id})")
     await state.finish()
-    logging.info(f"Автопостинг запущен: {name}, интервал {interval} ч.")
+    logging.info(f"Автопостинг запущен: {draft.name}, {_format_schedule(job)}")
+
+
+# ===================== Расписание =====================
+def next_run_after(job: AutopostJob, after: float) -> float:
+    if job.cron:
+        return CronSchedule(job.cron).next_after(after)
+    # Интервальная задача держит фазу: запуски идут строго через interval от планового
+    # времени, а не от момента окончания рассылки, пропущенные запуски не догоняются
+    planned = job.next_run_ms / 1000
+    if planned > after:
+        return planned
+    return planned + ((after - planned) // job.interval_s + 1) * job.interval_s
+
+
+def schedule_job(bot, job: AutopostJob):
+    jobs[job.id] = job
+    if not job.paused:
+        autopost_scheduler.schedule_at(job.next_run_ms / 1000, run_job, bot, job.id, key=("autopost", job.id))
+
+
+async def run_job(bot, job_id: int):
+    job = jobs.get(job_id)
+    if job is None or job.paused:
+        return
+    try:
+        await send_post(bot, job)
+    finally:
+        # За время рассылки задачу могли удалить или поставить на паузу
+        current = jobs.get(job_id)
+        if current is not None:
+            current = current._replace(next_run_ms=int(next_run_after(job, time.time()) * 1000))
+            jobs[job_id] = current
+            await db.set_autopost_next_run(job_id, current.next_run_ms)
+            if not current.paused:
+                schedule_job(bot, current)
+
+
+# Подъём задач из базы после перезапуска: просроченные отправляются сразу
+async def restore_autoposting(bot) -> int:
+    rows = await db.get_autopost_jobs()
+    for job in rows:
+        schedule_job(bot, job)
+    logging.info(f"Восстановлено задач автопостинга: {len(rows)}")
+    return len(rows)
 
 
 # ===================== Колбэки: Интервал =====================
 async def delete_interval(call: types.CallbackQuery, state: FSMContext):
-    await state.update_data(interval=None)
+    await state.update_data(interval=None, cron=None)
     data = await state.get_data()
     has_keyboard = bool(data.get('keyboard'))
     has_chates = bool(data.get('chates'))
@@ -111,12 +222,19 @@ async def add_interval(call: types.CallbackQuery, state: FSMContext):
 
 
 async def added_interval(call: types.CallbackQuery, state: FSMContext):
+    if call.data == "add_interval.cron":
+        await PinStates.enter_cron.set()
+        await call.message.edit_text(
+            "Введите расписание в формате cron: минута час день месяц день_недели\n"
+            "Например: 0 9 * * 1-5 — по будням в 9:00, */30 * * * * — каждые 30 минут"
+        )
+        return
     try:
         interval_str = call.data.split('.')[1]
         interval = 1/60 if interval_str == '7' else int(interval_str)  # 7 — раз в минуту
     except:
         interval = 1
-    await state.update_data(interval=interval)
+    await state.update_data(interval=interval, cron=None)
     data = await state.get_data()
     has_keyboard = bool(data.get('keyboard'))
     has_chates = bool(data.get('chates'))
@@ -125,11 +243,27 @@ async def added_interval(call: types.CallbackQuery, state: FSMContext):
     await PinStates.choose_action.set()
 
 
+async def enter_cron(message: types.Message, state: FSMContext):
+    try:
+        schedule = CronSchedule(message.text or "")
+        schedule.next_after(time.time())
+    except ValueError as e:
+        await message.answer(f"Некорректное расписание: {e}. Попробуйте ещё раз.")
+        return
+    await state.update_data(cron=str(schedule), interval=None)
+    data = await state.get_data()
+    has_keyboard = bool(data.get('keyboard'))
+    has_chates = bool(data.get('chates'))
+    kb = keyboards.in_autoposting(has_keyboard=has_keyboard, has_interval=True, has_chates=has_chates)
+    await message.answer(f"Расписание добавлено: {schedule}", reply_markup=kb)
+    await PinStates.choose_action.set()
+
+
 # ===================== Колбэки: Кнопки =====================
 async def delete_buttons(call: types.CallbackQuery, state: FSMContext):
     await state.update_data(keyboard=None)
     data = await state.get_data()
-    has_interval = bool(data.get('interval'))
+    has_interval = bool(data.get('interval') or data.get('cron'))
     has_chates = bool(data.get('chates'))
     kb = keyboards.in_autoposting(has_interval=has_interval, has_chates=has_chates)
     await call.message.edit_text("Кнопки удалены", reply_markup=kb)
@@ -157,7 +291,7 @@ async def enter_button_link(message: types.Message, state: FSMContext):
         else:
             kb = types.InlineKeyboardMarkup().add(types.InlineKeyboardButton(text=text, url=url))
         await state.update_data(keyboard=kb)
-        has_interval = bool(data.get('interval'))
+        has_interval = bool(data.get('interval') or data.get('cron'))
         has_chates = bool(data.get('chates'))
         reply_kb = keyboards.in_autoposting(has_keyboard=True, has_interval=has_interval, has_chates=has_chates)
         await message.answer("Кнопка добавлена", reply_markup=reply_kb)
@@ -175,62 +309,122 @@ async def choose_chats(call: types.CallbackQuery, state: FSMContext):
 
 
 async def select_chats(message: types.Message, state: FSMContext):
-    await state.update_data(chates=message.text.strip() or None)
+    # Ссылки разрешаются в chat_id сразу: ошибки видны при создании, а не в каждом запуске
+    links = parse_targets(message.text)
+    target_ids, invalid = await resolve_targets(message.bot, links or [])
+    if links and not target_ids:
+        await message.answer(f"Не удалось найти ни один чат: {', '.join(invalid)}. Проверьте ссылки и бота в чатах.")
+        return
+    valid = [link for link in links or [] if link not in invalid]
+    await state.update_data(chates=message.text.strip() or None, targets=valid or None, target_ids=target_ids or None)
     data = await state.get_data()
     has_keyboard = bool(data.get('keyboard'))
-    has_interval = bool(data.get('interval'))
+    has_interval = bool(data.get('interval') or data.get('cron'))
     kb = keyboards.in_autoposting(has_keyboard=has_keyboard, has_interval=has_interval, has_chates=True)
-    await message.answer("Чаты сохранены", reply_markup=kb)
+    text = f"Чаты сохранены: {len(target_ids)}"
+    if invalid:
+        text += f"\nНе найдены и пропущены: {', '.join(invalid)}"
+    await message.answer(text, reply_markup=kb)
     await PinStates.choose_action.set()
 
 
-# ===================== Отправщик сообщений =====================
-async def scheduled_sender(data):
-    message = data.get('message')
-    keyboard = data.get('keyboard')
-    interval = data.get('interval') or 1
-    chates = data.get('chates')
+# ===================== Цели =====================
+def parse_targets(chates):
+    if not chates:
+        return None
+    return [c.strip().replace('https://t.me/', '').replace('http://t.me/', '').replace('t.me/', '').lstrip('@')
+            for c in chates.split(',') if c.strip()]
 
-    entities = message.entities or message.caption_entities or []
 
-    while True:
-        try:
-            if chates:
-                chat_list = [c.strip().replace('https://t.me/', '').replace('http://t.me/', '').replace('t.me/', '').lstrip('@') for c in chates.split(',')]
-                for chat in chat_list:
-                    await send_to_chat(chat, message, keyboard, entities)
-            else:
-                for chat in db.get_all_chats():
-                    if chat[1] == 0:  # has_autoposting
-                        continue
-                    await send_to_chat(chat[0], message, keyboard, entities)
-        except Exception as e:
-            logging.error(f"Ошибка в автопостинге: {e}")
+# ===================== Разрешение целей =====================
+# Ссылка или id -> числовой chat_id через get_chat, с кэшем на chat_id_cache.ttl
+async def resolve_chat(bot, link: str) -> int:
+    key = link.lower()
+    chat_id = chat_id_cache.get(key)
+    if chat_id is None:
+        chat = await bot.get_chat(link if link.lstrip('-').isdigit() else '@' + link)
+        chat_id = chat.id
+        chat_id_cache.set(key, chat_id)
+    return chat_id
 
-        await asyncio.sleep(interval * 3600)
 
+async def resolve_targets(bot, links: List[str]) -> Tuple[List[int], List[str]]:
+    target_ids, invalid = [], []
+    for link in links:
+        try:
+            target_ids.append(await resolve_chat(bot, link))
+        except TelegramAPIError as e:
+            logging.warning(f"Автопостинг: чат {link} не найден: {e}")
+            invalid.append(link)
+    return target_ids, invalid
+
+
+# Задача без разрешённых id (создана до их появления) — разрешаем один раз и сохраняем
+async def ensure_target_ids(bot, job: AutopostJob) -> AutopostJob:
+    if not job.targets or job.target_ids:
+        return job
+    target_ids, invalid = await resolve_targets(bot, job.targets)
+    if not target_ids:
+        # Пустой список целей значил бы "все чаты" — оставляем как есть до следующей попытки
+        return job
+    targets = [link for link in job.targets if link not in invalid]
+    return await _update_targets(job, targets, target_ids)
+
+
+# Ошибки отправки: группа стала супергруппой — берём новый id; чат не найден —
+# сбрасываем кэш и разрешаем ссылку заново
+async def repair_targets(bot, job: AutopostJob, failed: Dict[int, Exception]) -> AutopostJob:
+    targets, target_ids = list(job.targets), list(job.target_ids)
+    changed = False
+    for index, chat_id in enumerate(target_ids):
+        error = failed.get(chat_id)
+        if isinstance(error, MigrateToChat):
+            target_ids[index] = error.migrate_to_chat_id
+            chat_id_cache.set(targets[index].lower(), error.migrate_to_chat_id)
+            changed = True
+        elif isinstance(error, ChatNotFound):
+            chat_id_cache.pop(targets[index].lower())
+            try:
+                new_id = await resolve_chat(bot, targets[index])
+            except TelegramAPIError:
+                continue
+            if new_id != chat_id:
+                target_ids[index] = new_id
+                changed = True
+    if not changed:
+        return job
+    logging.info(f"Автопостинг {job.id}: цели обновлены после ошибок отправки")
+    return await _update_targets(job, targets, target_ids)
+
+
+async def _update_targets(job: AutopostJob, targets: List[str], target_ids: List[int]) -> AutopostJob:
+    job = job._replace(targets=targets or None, target_ids=target_ids or None)
+    await db.set_autopost_targets(job.id, job.targets, job.target_ids)
+    if job.id in jobs:
+        jobs[job.id] = jobs[job.id]._replace(targets=job.targets, target_ids=job.target_ids)
+    return job
 
-async def send_to_chat(chat_id, original, keyboard, entities):
-    try:
-        if isinstance(chat_id, str) and not chat_id.isdigit():
-            chat_id = '@' + chat_id
-
-        if original.photo:
-            await original.bot.send_photo(chat_id, original.photo[-1].file_id,
-                                          caption=original.caption or original.text,
-                                          reply_markup=keyboard, caption_entities=entities)
-        elif original.video:
-            await original.bot.send_video(chat_id, original.video.file_id, caption=original.caption,
-                                          reply_markup=keyboard)
-        elif original.document:
-            await original.bot.send_document(chat_id, original.document.file_id, caption=original.caption,
-                                              reply_markup=keyboard)
-        else:
-            await original.bot.send_message(chat_id, original.text or original.caption,
-                                            reply_markup=keyboard, entities=entities)
-        await asyncio.sleep(1)
-    except Exception as e:
-        logging.error(f"Не удалось отправить в {chat_id}: {e}")
+
+# ===================== Отправщик сообщений =====================
+# Черновик собирается один раз на запуск, в каждый чат уходит один готовый вызов
+async def send_post(bot, job: AutopostJob):
+    draft = PostDraft.from_dict(job.content, job.keyboard)
+    if job.targets:
+        job = await ensure_target_ids(bot, job)
+        targets = job.target_ids or []
+    else:
+        targets = [chat.chat_id for chat in await db.get_all_chats() if chat.has_autoposting]
+    result = await chat_health.run(targets, lambda chat_id: broadcaster.call(chat_id, draft.send, bot, chat_id))
+    if job.target_ids and result.failed:
+        await repair_targets(bot, job, result.failed)
+    if draft.to_dict() != job.content:
+        # Исходник удалён и черновик перешёл на file_id (или задача старого формата) — сохраняем,
+        # чтобы не пробовать copy_message заново
+        await db.set_autopost_content(job.id, draft.to_dict())
+        if job.id in jobs:
+            jobs[job.id] = jobs[job.id]._replace(content=draft.to_dict())
+    logging.info(f"Автопостинг {job.id}: отправлено {len(result.sent)}, ошибок {len(result.failed)} "
+                 f"за {result.elapsed:.1f} с")
 
 
 # ===================== Регистрация хэндлеров =====================
@@ -241,12 +435,15 @@ def register_autoposting_handlers(dp):
     dp.register_message_handler(autoposting_list, commands=['autoposting_list'])
     dp.register_message_handler(autoposting_del, commands=['autoposting_del'])
     dp.register_message_handler(autoposting_off, commands=['autoposting_off'])
+    dp.register_message_handler(autoposting_pause, commands=['autoposting_pause'])
+    dp.register_message_handler(autoposting_resume, commands=['autoposting_resume'])
 
     dp.register_callback_query_handler(start_autoposting, text="start_autoposting", state=PinStates.choose_action)
 
     dp.register_callback_query_handler(delete_interval, text="delete_interval", state="*")
     dp.register_callback_query_handler(add_interval, text="add_interval", state="*")
     dp.register_callback_query_handler(added_interval, text_contains="add_interval.", state=PinStates.interval_add)
+    dp.register_message_handler(enter_cron, state=PinStates.enter_cron)
 
     dp.register_callback_query_handler(delete_buttons, text="delete_buttons", state="*")
     dp.register_callback_query_handler(add_keyboard_button, text="add_keyboard_button", state=PinStates.choose_action)
@@ -254,5 +451,5 @@ def register_autoposting_handlers(dp):
     dp.register_message_handler(enter_button_text, state=PinStates.enter_button_text)
     dp.register_message_handler(enter_button_link, state=PinStates.enter_button_link)
 
-    dp.register_callback_query_handler(choose_chats, text="choose_chates", state="*")
+    dp.register_callback_query_handler(choose_chats, text="choose_chats", state="*")
     dp.register_message_handler(select_chats, state=PinStates.chates)
\ No newline at end of file
@@ -1,17 +1,21 @@
 import asyncio
 import logging
-import re
-from datetime import datetime
 from aiogram import types
 from aiogram.dispatcher import FSMContext
 from aiogram.utils.exceptions import MessageNotModified
 from config import ADMINS_ID
-import database
-from utils import send_captcha, lift_restrictions, check_bot_permissions
+from cache import member_cache
+from chat_health import chat_health
+from database import db
+from ratelimit import rate_limiter
+from raid import raid_guard
+import captcha_tokens
+import stopwords
+from scheduler import delete_message_later
+from utils import send_captcha, lift_restrictions, check_bot_permissions, get_member_status, cancel_captcha_timeout, \
+    confirm_restrictions_lifted, update_bot_rights
 from handlers.menu import show_main_menu  # импорт меню
 
-db = database.MainDb()
-
 # ===================== /start =====================
 async def cmd_start(message: types.Message, state: FSMContext):
     await state.finish()
@@ -30,14 +34,25 @@ async def handle_new_member(update: types.ChatMemberUpdated, state: FSMContext):
     chat_id = update.chat.id
     user_id = new_member.user.id
 
-    if user_id == (await update.bot.get_me()).id:
+    # Обновление chat_member — свежий статус, кладём в кэш без запроса к API
+    member_cache.set((chat_id, user_id), new_member.status)
+    confirm_restrictions_lifted(chat_id, user_id, new_member)
+
+    if user_id == update.bot.id:
+        return
+
+    # Всплеск вступлений — рейд-режим с общей капчей, без проверок на каждого
+    joined = update.old_chat_member.status in ['left', 'kicked', 'banned'] and new_member.status == 'member'
+    if joined and await raid_guard.on_join(update.bot, chat_id, new_member.user):
         return
 
     if not await check_bot_permissions(update.bot, chat_id):
         return
 
     if new_member.status in ['left', 'kicked', 'banned']:
-        db.delete_captcha_status(user_id, chat_id)
+        raid_guard.forget(chat_id, user_id, update.bot)
+        cancel_captcha_timeout(chat_id, user_id)
+        await db.delete_captcha_status(user_id, chat_id)
         logging.info(f"Captcha status deleted for user {user_id} in chat {chat_id} (user left)")
 
 # ===================== Ответ на капчу =====================
@@ -45,31 +60,24 @@ async def check_captcha(call: types.CallbackQuery, state: FSMContext):
     user_id = call.from_user.id
     chat_id = call.message.chat.id
 
-    try:
-        _, selected_answer, cb_chat_id, cb_user_id = call.data.split("_")
-        selected_answer = int(selected_answer)
-        cb_chat_id = int(cb_chat_id)
-        cb_user_id = int(cb_user_id)
-    except ValueError:
-        await call.answer("Ошибка капчи.", show_alert=True)
+    # Подпись, срок и правильность ответа проверяются по самому токену — без базы
+    token = captcha_tokens.verify(call.data)
+    if token is None:
+        await call.answer("Ошибка капчи или капча устарела.", show_alert=True)
         return
 
-    if user_id != cb_user_id or chat_id != cb_chat_id:
-        await call.answer("Это не ваша капча!")
+    # Общая капча рейд-режима: отвечает любой из перечисленных в ней участников
+    if token.user_id == captcha_tokens.ANY_USER and chat_id == token.chat_id:
+        await raid_guard.answer(call, token)
         return
 
-    attempts = db.increment_captcha_attempts(user_id, chat_id)
-
-    # Определяем правильный ответ
-    question_line = call.message.text.split("\n")[1] if "\n" in call.message.text else ""
-    match = re.search(r'(\d+)\s*\+\s*(\d+)', question_line)
-    if not match:
-        await call.answer("Ошибка в вопросе капчи.")
+    if user_id != token.user_id or chat_id != token.chat_id:
+        await call.answer("Это не ваша капча!")
         return
-    correct_answer = int(match.group(1)) + int(match.group(2))
 
-    if selected_answer == correct_answer:
-        db.update_captcha_status(user_id, chat_id)
+    if token.correct:
+        await db.update_captcha_status(user_id, chat_id)
+        cancel_captcha_timeout(chat_id, user_id)
         if await lift_restrictions(call.bot, chat_id, user_id):
             try:
                 await call.message.delete()
@@ -78,6 +86,8 @@ async def check_captcha(call: types.CallbackQuery, state: FSMContext):
             await call.answer("Капча пройдена! Вы можете писать в чат.", show_alert=True)
         return
 
+    # Попытка уже засчитана при выдаче капчи в send_captcha
+    attempts = await db.get_captcha_attempts(user_id, chat_id)
     remaining = 3 - attempts
     try:
         await call.message.delete()
@@ -91,6 +101,16 @@ async def check_captcha(call: types.CallbackQuery, state: FSMContext):
     else:
         await call.answer("Превышено количество попыток. Вы забанены на 24 часа.", show_alert=True)
 
+# ===================== Статус самого бота и миграция группы =====================
+async def handle_bot_status(update: types.ChatMemberUpdated):
+    # Права бота меняются только через это обновление — реестр прав не ходит в API
+    update_bot_rights(update.chat.id, update.new_chat_member)
+    await chat_health.on_my_chat_member(update)
+
+
+async def handle_migration(message: types.Message):
+    await chat_health.migrate(message.chat.id, message.migrate_to_chat_id)
+
 # ===================== Обработка обычных сообщений в чате =====================
 async def message_in_chat(message: types.Message, state: FSMContext):
     if message.chat.type not in ["group", "supergroup"]:
@@ -100,51 +120,56 @@ async def message_in_chat(message: types.Message, state: FSMContext):
     chat_id = message.chat.id
 
     try:
-        member = await message.bot.get_chat_member(chat_id, user_id)
-        if member.status in ['left', 'kicked', 'banned']:
+        status = await get_member_status(message.bot, chat_id, user_id)
+        if status in ['left', 'kicked', 'banned']:
             return
-        if member.status in ['creator', 'administrator']:
-            db.update_last_message_time(user_id, chat_id)
+        if status in ['creator', 'administrator']:
             return
     except Exception as e:
         logging.error(f"Ошибка получения статуса пользователя {user_id} в чате {chat_id}: {e}")
         return
 
-    # Кулдаун
-    cooldown = db.get_message_cooldown(chat_id)
-    if cooldown > 0:
-        last_time = db.get_last_message_time(user_id, chat_id)
-        if last_time and (datetime.now() - last_time).total_seconds() < cooldown:
+    # Участник из общей капчи, ограничение которого ещё в очереди
+    if raid_guard.is_pending(chat_id, user_id):
+        try:
+            await message.delete()
+        except Exception as e:
+            logging.warning(f"Не удалось удалить сообщение {message.message_id} участника рейда: {e}")
+        return
+
+    # Кулдаун: rate_limit_count сообщений за message_cooldown секунд, без обращений к базе
+    settings = await db.get_chat(chat_id)
+    if settings and settings.message_cooldown > 0:
+        wait = rate_limiter.hit(chat_id, user_id, settings.rate_limit_count, settings.message_cooldown)
+        if wait:
             try:
                 await message.delete()
-                remaining = int(cooldown - (datetime.now() - last_time).total_seconds())
+                remaining = max(int(wait), 1)
                 noti = await message.answer(f"Подождите ещё {remaining} сек.")
-                await asyncio.sleep(10)
-                await noti.delete()
+                delete_message_later(message.bot, chat_id, noti.message_id, 10)
             except Exception as e:
                 logging.warning(f"Ошибка при удалении/уведомлении сообщения {message.message_id}: {e}")
             return
 
     # Капча и стоп-слова
-    if db.have_stop_words(chat_id):
-        if not db.check_captcha_status(user_id, chat_id):
+    if await db.have_stop_words(chat_id):
+        if not await db.check_captcha_status(user_id, chat_id):
             try:
                 await message.delete()
             except Exception as e:
                 logging.warning(f"Не удалось удалить сообщение {message.message_id} для капчи: {e}")
 
-            old_msg_id = db.get_captcha_message_id(user_id, chat_id)
+            old_msg_id = await db.get_captcha_message_id(user_id, chat_id)
             if old_msg_id:
                 try:
                     await message.bot.delete_message(chat_id, old_msg_id)
                 except Exception as e:
                     logging.warning(f"Не удалось удалить старую капчу {old_msg_id}: {e}")
 
-            db.delete_captcha_status(user_id, chat_id)
+            await db.delete_captcha_status(user_id, chat_id)
 
             try:
-                member = await message.bot.get_chat_member(chat_id, user_id)
-                if member.status in ['left', 'kicked', 'banned']:
+                if await get_member_status(message.bot, chat_id, user_id) in ['left', 'kicked', 'banned']:
                     return
             except:
                 return
@@ -153,22 +178,19 @@ async def message_in_chat(message: types.Message, state: FSMContext):
             return
 
         # Проверка стоп-слов
-        text = (message.text or message.caption or "").lower()
-        text_words = re.findall(r'\w+', text, flags=re.UNICODE)
-        stop_words = {w.lower() for w in db.get_all_stop_words()}
-        if any(word in stop_words for word in text_words):
+        if stopwords.find_stop_word(message.text or message.caption or ""):
             try:
                 await message.delete()
             except Exception as e:
                 logging.warning(f"Не удалось удалить сообщение с стоп-словом {message.message_id}: {e}")
             return
 
-    db.update_last_message_time(user_id, chat_id)
-
 # ===================== Регистрация =====================
 def register_common_handlers(dp):
     dp.register_message_handler(cmd_start, commands=['start'])
     dp.register_chat_member_handler(handle_new_member)
-    dp.register_callback_query_handler(check_captcha, text_contains="captcha_")
+    dp.register_my_chat_member_handler(handle_bot_status)
+    dp.register_message_handler(handle_migration, content_types=types.ContentType.MIGRATE_TO_CHAT_ID)
+    dp.register_callback_query_handler(check_captcha, text_startswith=captcha_tokens.PREFIX)
     dp.register_message_handler(message_in_chat, content_types=types.ContentType.ANY,
                                 chat_type=[types.ChatType.GROUP, types.ChatType.SUPERGROUP])
\ No newline at end of file
@@ -3,12 +3,10 @@ from aiogram.dispatcher import FSMContext
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
 from config import ADMINS_ID
-import database
+from database import db
 from utils import send_captcha
 from pin_states import PinStates
 
-db = database.MainDb()
-
 
 # ================== Главное меню ==================
 def main_menu(is_admin=False):
@@ -80,7 +78,7 @@ async def menu_callback(call: types.CallbackQuery, state: FSMContext):
             await delete_chat(call.message)
         elif call.data == "menu_toggle_stopwords":
             chat_id = call.message.chat.id
-            current = db.get_chat(chat_id)[3]  # has_stopwords
+            current = (await db.get_chat(chat_id))[3]  # has_stopwords
             if current:
                 await db.update_chat_settings(chat_id, has_stopwords=0)
                 await call.message.edit_text("Стоп-слова и капча выключены")
@@ -89,7 +87,7 @@ async def menu_callback(call: types.CallbackQuery, state: FSMContext):
                 await call.message.edit_text("Стоп-слова и капча включены")
         elif call.data == "menu_toggle_pinning":
             chat_id = call.message.chat.id
-            current = db.get_chat(chat_id)[2]  # has_autopining
+            current = (await db.get_chat(chat_id))[2]  # has_autopining
             if current:
                 await db.update_chat_settings(chat_id, has_autopining=0)
                 await call.message.edit_text("Закрепление выключено")
@@ -98,7 +96,7 @@ async def menu_callback(call: types.CallbackQuery, state: FSMContext):
                 await call.message.edit_text("Закрепление включено")
         elif call.data == "menu_toggle_autoposting":
             chat_id = call.message.chat.id
-            current = db.get_chat(chat_id)[1]  # has_autoposting
+            current = (await db.get_chat(chat_id))[1]  # has_autoposting
             if current:
                 await db.update_chat_settings(chat_id, has_autoposting=0)
                 await call.message.edit_text("Автопостинг выключен")
@@ -1,16 +1,20 @@
-import asyncio
 import logging
+import time
+from datetime import datetime
+from typing import Dict, List
 
 from aiogram import types
 from aiogram.dispatcher import FSMContext
+from aiogram.utils.exceptions import BadRequest
 
-import database
+from broadcast import broadcaster
+from chat_health import chat_health
+from database import db
+from drafts import PostDraft, collect_messages, first_message_id
 from pin_states import PinStates
 import keyboards
 from utils import check_bot_permissions
 
-db = database.MainDb()
-
 
 # ===================== Начало процесса закрепления =====================
 async def joined_pin(message: types.Message):
@@ -20,33 +24,103 @@ async def joined_pin(message: types.Message):
 
 # ===================== Получаем сообщение для закрепления =====================
 async def got_message_pin(message: types.Message, state: FSMContext):
-    await state.update_data(message=message)
+    messages = await collect_messages(message)
+    if messages is None:
+        return
+    await state.update_data(message=messages[0], messages=messages)
     await PinStates.choose_action.set()
     await message.answer("Выберите действие", reply_markup=keyboards.in_message_sending())
 
 
-# ===================== Открепление всех сообщений =====================
+# ===================== Открепление =====================
+# /unpin — все закрепы; /unpin campaign 12, /unpin chat -100123 (или here), /unpin older 24h —
+# только часть. Фильтры можно сочетать. Чаты обрабатываются параллельно в пределах лимитов
+# рассылки, строка удаляется из базы сразу после успешного открепления. /unpin list — номера кампаний
+UNPIN_USAGE = ("Использование: /unpin [campaign номер] [chat id|here] [older 30m|24h|7d]\n"
+               "Без аргументов — открепить всё. /unpin list — список кампаний.")
+AGE_UNITS = {"m": 60, "h": 3600, "d": 86400}
+# Текст ошибки unpin_chat_message, когда сообщения уже нет
+UNPIN_MISSING_ERROR = "message to unpin not found"
+
+
+def parse_unpin_scope(args: str, current_chat_id: int) -> dict:
+    words = args.split()
+    if len(words) % 2:
+        raise ValueError(UNPIN_USAGE)
+    scope = {}
+    for key, value in zip(words[::2], words[1::2]):
+        if key == "campaign" and value.isdigit():
+            scope["campaign_id"] = int(value)
+        elif key == "chat":
+            scope["chat_id"] = current_chat_id if value == "here" else int(value)
+        elif key == "older" and value[:-1].isdigit() and value[-1] in AGE_UNITS:
+            scope["older_than_ms"] = int((time.time() - int(value[:-1]) * AGE_UNITS[value[-1]]) * 1000)
+        else:
+            raise ValueError(UNPIN_USAGE)
+    return scope
+
+
+async def list_pin_campaigns(message: types.Message):
+    campaigns = await db.get_pin_campaigns()
+    if not campaigns:
+        await message.answer("Нет закреплённых сообщений.")
+        return
+    lines = [f"{campaign_id}. {name} — {datetime.fromtimestamp(created_ms / 1000).strftime('%d.%m %H:%M')}, "
+             f"закрепов: {count}" for campaign_id, name, created_ms, count in campaigns]
+    await message.answer("Кампании закрепов:\n" + "\n".join(lines) + "\n\nОткрепить: /unpin campaign номер")
+
+
 async def unpin_last_messages(message: types.Message):
     logging.info(f"/unpin от {message.from_user.id} в чате {message.chat.id}")
+    args = message.get_args() or ""
+    if args.strip() == "list":
+        await list_pin_campaigns(message)
+        return
     try:
-        messages = db.get_pinned_messages()
-        if not messages:
-            await message.answer("Нет закреплённых сообщений.")
-            return
-
-        for message_id, chat_id in messages:
-            try:
-                await message.bot.unpin_chat_message(chat_id, message_id)
-                await message.bot.delete_message(chat_id, message_id)
-                logging.info(f"Откреплено и удалено {message_id} в {chat_id}")
-            except Exception as e:
-                logging.error(f"Ошибка открепления {message_id} в {chat_id}: {e}")
-
-        await message.answer("Все закреплённые сообщения откреплены и удалены")
-        # db.clear_pinned_messages()  # если есть метод очистки
-    except Exception as e:
-        logging.error(f"Ошибка /unpin: {e}")
-        await message.answer("Ошибка при откреплении.")
+        scope = parse_unpin_scope(args, message.chat.id)
+    except ValueError:
+        await message.answer(UNPIN_USAGE)
+        return
+
+    by_chat: Dict[int, List[int]] = {}
+    for message_id, chat_id in await db.get_pinned_messages(**scope):
+        by_chat.setdefault(chat_id, []).append(message_id)
+    if not by_chat:
+        await message.answer("Нет закреплённых сообщений.")
+        return
+
+    bot = message.bot
+
+    async def unpin_chat(chat_id):
+        done = []
+        try:
+            for message_id in by_chat.get(chat_id, []):
+                try:
+                    await broadcaster.call(chat_id, bot.unpin_chat_message, chat_id, message_id)
+                except BadRequest as e:
+                    # Уже откреплено или удалено вручную — строка больше не нужна. ChatNotFound
+                    # и прочие ошибки чата уходят в chat_health
+                    if UNPIN_MISSING_ERROR not in str(e).lower():
+                        raise
+                done.append(message_id)
+                try:
+                    await broadcaster.call(chat_id, bot.delete_message, chat_id, message_id)
+                except BadRequest as e:
+                    logging.warning(f"Откреплено, но не удалено {message_id} в {chat_id}: {e}")
+        finally:
+            if done:
+                await db.delete_pinned_messages(chat_id, done)
+        return len(done)
+
+    total = sum(len(message_ids) for message_ids in by_chat.values())
+    result = await chat_health.run(by_chat, unpin_chat)
+    unpinned = sum(result.sent.values())
+    logging.info(f"Открепление: {unpinned} из {total} в {len(by_chat)} чатах, ошибок {len(result.failed)} "
+                 f"за {result.elapsed:.1f} с")
+    text = f"Откреплено и удалено сообщений: {unpinned} из {total}"
+    if unpinned < total:
+        text += f"\nОстальные остались в базе (ошибки в {len(result.failed)} чатах или бота нет в чате)"
+    await message.answer(text)
 
 
 # ===================== Колбэк: Отмена отправки =====================
@@ -61,62 +135,31 @@ async def cancel_sending(call: types.CallbackQuery, state: FSMContext):
 # ===================== Колбэк: Отправка и закрепление =====================
 async def send_and_pin_message(call: types.CallbackQuery, state: FSMContext):
     data = await state.get_data()
-    original = data.get('message')
-    keyboard = data.get('keyboard')
-
-    messages = []
-    chats = db.get_all_chats()
-
-    for chat in chats:
-        chat_id = chat[0]
-        if chat[2] == 0:  # has_autopining
-            continue
-
-        if not await check_bot_permissions(call.bot, chat_id):
-            continue
-
-        try:
-            if original.photo:
-                sent = await call.bot.send_photo(
-                    chat_id, original.photo[-1].file_id,
-                    caption=original.caption or original.text,
-                    reply_markup=keyboard,
-                    caption_entities=original.caption_entities or original.entities
-                )
-            elif original.video:
-                sent = await call.bot.send_video(
-                    chat_id, original.video.file_id,
-                    caption=original.caption,
-                    reply_markup=keyboard
-                )
-            elif original.document:
-                sent = await call.bot.send_document(
-                    chat_id, original.document.file_id,
-                    caption=original.caption,
-                    reply_markup=keyboard
-                )
-            else:
-                sent = await call.bot.send_message(
-                    chat_id, original.text or original.caption,
-                    reply_markup=keyboard,
-                    entities=original.entities or original.caption_entities
-                )
-
-            messages.append(sent)
-            await asyncio.sleep(1)
-            await call.bot.pin_chat_message(chat_id, sent.message_id, disable_notification=True)
-            await asyncio.sleep(1)
-        except Exception as e:
-            logging.error(f"Ошибка отправки/закрепления в {chat_id}: {e}")
-
-    # Сохраняем закреплённые сообщения в БД
-    for msg in messages:
-        try:
-            db.insert_pinned_message(msg.message_id, msg.chat.id)
-        except:
-            pass
-
-    await call.message.edit_text("Сообщение успешно отправлено и закреплено во всех чатах")
+    # Готовый вызов собирается один раз, в каждый чат — copy_message (или альбом) и закреп
+    draft = PostDraft.from_messages(data.get('messages'), data.get('keyboard'))
+    campaign_id = await db.add_pin_campaign(draft.name)
+    bot = call.bot
+
+    async def send_and_pin(chat_id):
+        if not await check_bot_permissions(bot, chat_id):
+            return None
+        message_id = first_message_id(await broadcaster.call(chat_id, draft.send, bot, chat_id))
+        await broadcaster.call(chat_id, bot.pin_chat_message, chat_id, message_id, disable_notification=True)
+        return message_id
+
+    # Рассылка параллельно в пределах общих лимитов, по одному чату не ждём;
+    # чаты, где бота уже нет, отсеиваются до рассылки
+    chats = [chat.chat_id for chat in await db.get_all_chats() if chat.has_autopining]
+    result = await chat_health.run(chats, send_and_pin)
+    # copy_message возвращает только message_id — чат берём из ключа результата
+    pinned = [(chat_id, message_id) for chat_id, message_id in result.sent.items() if message_id is not None]
+    logging.info(f"Закреп: отправлено {len(pinned)}, ошибок {len(result.failed)} за {result.elapsed:.1f} с")
+
+    # Сохраняем закреплённые сообщения в БД одной транзакцией
+    await db.insert_pinned_messages(campaign_id, pinned)
+
+    await call.message.edit_text(f"Сообщение закреплено в {len(pinned)} чатах (кампания {campaign_id}).\n"
+                                 f"Открепить: /unpin campaign {campaign_id}")
     await state.finish()
 
 
@@ -1,5 +1,8 @@
 from aiogram import types
 import random
+import time
+
+import captcha_tokens
 
 # ===================== Главное меню =====================
 def main_menu():
@@ -33,23 +36,26 @@ def in_message_sending(has_keyboard=False, has_interval=False):
     return keyboard
 
 # ===================== Капча =====================
-def get_captcha_keyboard(correct_answer: int, chat_id: int, user_id: int):
+# В callback_data — подписанный токен: проверка ответа без базы и без разбора текста сообщения
+def get_captcha_keyboard(correct_answer: int, chat_id: int, user_id: int, expires: int = None):
     keyboard = types.InlineKeyboardMarkup(row_width=4)
+    expires = expires or int(time.time()) + 3600
+    challenge_id = captcha_tokens.new_challenge_id()
     answers = [correct_answer, correct_answer + 1, correct_answer - 1, correct_answer + 2]
     random.shuffle(answers)
     for ans in answers:
         keyboard.insert(types.InlineKeyboardButton(
             str(ans),
-            callback_data=f"captcha_{ans}_{chat_id}_{user_id}"
+            callback_data=captcha_tokens.sign(chat_id, user_id, challenge_id, expires, ans, correct_answer)
         ))
     return keyboard
 
 # ===================== Автопостинг =====================
-def in_autoposting(has_keyboard=False, has_interval=False, has_chats=False):
+def in_autoposting(has_keyboard=False, has_interval=False, has_chates=False):
     keyboard = types.InlineKeyboardMarkup(row_width=1)
     keyboard.add(types.InlineKeyboardButton(text="Начать автопостинг", callback_data="start_autoposting"))
 
-    if has_chats:
+    if has_chates:
         keyboard.add(types.InlineKeyboardButton(text='Чаты выбраны', callback_data='chats_chosen'))
     else:
         keyboard.add(types.InlineKeyboardButton(text='Выбрать чаты', callback_data='choose_chats'))
@@ -74,4 +80,5 @@ def in_interval_adding():
     intervals = [("1 минута", 7), ("1 час", 1), ("2 часа", 2), ("3 часа", 3), ("4 часа", 4), ("6 часов", 6)]
     for text, cb in intervals:
         keyboard.insert(types.InlineKeyboardButton(text=text, callback_data=f"add_interval.{cb}"))
+    keyboard.add(types.InlineKeyboardButton(text="Своё расписание (cron)", callback_data="add_interval.cron"))
     return keyboard
\ No newline at end of file
@@ -2,12 +2,19 @@ import asyncio
 import logging
 
 from aiogram import Bot, Dispatcher, types
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.utils import executor
 
-from config import TOKEN
-from database import MainDb
+from config import TOKEN, MODE, API_SERVER_URL
+from database import db
 import handlers
+from handlers.autoposting import autopost_scheduler, restore_autoposting
+import ratelimit
+from scheduler import scheduler
+from utils import restore_captcha_deadlines
+from webhook import start_webhook
+import stopwords
 
 # Логи в файл и консоль — надёжная версия
 logger = logging.getLogger()
@@ -32,7 +39,8 @@ logger.addHandler(console_handler)
 
 logging.info("Логи успешно настроены — теперь всё будет писаться в bot.log")
 
-bot = Bot(token=TOKEN, parse_mode=types.ParseMode.HTML)
+server = TelegramAPIServer.from_base(API_SERVER_URL) if API_SERVER_URL else TELEGRAM_PRODUCTION
+bot = Bot(token=TOKEN, parse_mode=types.ParseMode.HTML, server=server)
 storage = MemoryStorage()
 dp = Dispatcher(bot, storage=storage)
 
@@ -40,13 +48,37 @@ dp = Dispatcher(bot, storage=storage)
 handlers.register_all(dp)
 
 async def on_startup(_):
-    db = MainDb()
-    db.create_tables()
+    await stopwords.reload_stop_words(await db.get_all_stop_words())
+    # Единая очередь отложенных удалений/банов/таймаутов капчи
+    asyncio.create_task(scheduler.run())
+    # Таймауты капчи, которые ждали во время простоя
+    await restore_captcha_deadlines(bot)
+    # Задачи автопостинга из базы — в своей куче расписания
+    asyncio.create_task(autopost_scheduler.run())
+    await restore_autoposting(bot)
+    # Состояние лимитера сообщений переживает перезапуск
+    await ratelimit.restore_rate_limits()
+    asyncio.create_task(ratelimit.run_snapshots())
+    # Периодическая очистка устаревших статусов капчи и возврат свободных страниц файла
+    asyncio.create_task(db.run_retention_job())
     logging.info("Бот запущен и готов к работе!")
 
+async def on_shutdown(_):
+    # Сохраняем снимок лимитера сообщений в базу перед выходом
+    await ratelimit.save_rate_limits()
+    await db.close()
+    logging.info("Бот остановлен")
+
 if __name__ == '__main__':
-    executor.start_polling(
-        dp,
-        skip_updates=True,
-        on_startup=on_startup
-    )
\ No newline at end of file
+    if MODE == 'webhook':
+        # aiohttp-сервер + очередь обновлений (см. webhook.py); простой не теряет обновления
+        start_webhook(dp, on_startup, on_shutdown)
+    else:
+        executor.start_polling(
+            dp,
+            skip_updates=True,
+            # chat_member не приходит без явного запроса — на нём держится кэш статусов
+            allowed_updates=types.AllowedUpdates.all(),
+            on_startup=on_startup,
+            on_shutdown=on_shutdown
+        )
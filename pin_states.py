@@ -8,6 +8,7 @@ class PinStates(StatesGroup):
     enter_button_text = State()   # Ввод текста кнопки
     enter_button_link = State()   # Ввод ссылки кнопки
     chates = State()              # Выбор чатов для автопостинга
+    enter_cron = State()          # Ввод cron-расписания для автопостинга
 
     # ==================== Для /autoposting ====================
     enter_message_1 = State()     # Получение сообщения для автопостинга
\ No newline at end of file
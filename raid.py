@@ -0,0 +1,248 @@
+import html
+import itertools
+import logging
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+from aiogram import types
+from aiogram.utils.exceptions import MessageNotModified, RetryAfter, TelegramAPIError
+
+import captcha_tokens
+from cache import member_cache
+from database import db
+from keyboards import get_captcha_keyboard
+from scheduler import scheduler, action_queue, ban_paced, restrict_paced
+from utils import captcha_batch_timeout, check_bot_permissions, generate_captcha, lift_restrictions, \
+    unrestrict_paced
+
+# Всплеск: RAID_JOIN_THRESHOLD вступлений за RAID_JOIN_WINDOW секунд включает рейд-режим,
+# он держится ещё RAID_COOLDOWN секунд после последнего вступления
+RAID_JOIN_THRESHOLD = 10
+RAID_JOIN_WINDOW = 10
+RAID_COOLDOWN = 120
+# Одно сообщение капчи на пачку до RAID_BATCH_SIZE участников.
+# Первая отправка ждёт RAID_FIRST_FLUSH секунд, чтобы собрать начало волны,
+# дальше текст правится не чаще раза в RAID_EDIT_INTERVAL секунд
+RAID_BATCH_SIZE = 50
+RAID_FIRST_FLUSH = 1
+RAID_EDIT_INTERVAL = 3
+RAID_MAX_ATTEMPTS = 3
+
+
+def _mention(user: types.User) -> str:
+    if user.username:
+        return f"@{user.username}"
+    name = html.escape((user.first_name or "Пользователь")[:32])
+    return f'<a href="tg://user?id={user.id}">{name}</a>'
+
+
+# Общая капча: один вопрос и одно сообщение на всех участников пачки
+class RaidBatch:
+    def __init__(self, batch_id: int, chat_id: int, timeout: int):
+        self.batch_id = batch_id
+        self.chat_id = chat_id
+        self.timeout = timeout
+        self.deadline = time.time() + timeout
+        self.message_id: Optional[int] = None
+        self.question, answer = generate_captcha()
+        self.keyboard = get_captcha_keyboard(answer, chat_id, captcha_tokens.ANY_USER, int(self.deadline))
+        # Ожидающие ответа: user_id -> упоминание; unsaved — ещё не записанные в базу
+        self.users: Dict[int, str] = {}
+        self.unsaved: List[int] = []
+        self.flush_scheduled = False
+        self.closed = False
+
+    def text(self) -> str:
+        return (
+            "Массовое вступление в чат. Пройдите капчу, чтобы писать в чат:\n"
+            f"{', '.join(self.users.values())}\n\n"
+            f"{self.question}\n"
+            f"Попыток у каждого: {RAID_MAX_ATTEMPTS}. Капча исчезнет через {self.timeout} секунд."
+        )
+
+
+# Рейд-режим: при всплеске вступлений новые участники ограничиваются через очередь
+# с темпом и получают одну общую капчу вместо сообщения и restrict на каждого
+class RaidGuard:
+    def __init__(self):
+        self._joins: Dict[int, Deque[float]] = {}
+        self._raid_until: Dict[int, float] = {}
+        self._ids = itertools.count(1)
+        # Текущая пачка чата, в которую добавляются новые участники
+        self._open: Dict[int, RaidBatch] = {}
+        self._pending: Dict[Tuple[int, int], RaidBatch] = {}
+        self.raids = 0
+        self.users = 0
+        self.messages = 0
+        self.edits = 0
+
+    def is_active(self, chat_id: int) -> bool:
+        return self._raid_until.get(chat_id, 0) > time.time()
+
+    def is_pending(self, chat_id: int, user_id: int) -> bool:
+        return (chat_id, user_id) in self._pending
+
+    def record_join(self, chat_id: int) -> bool:
+        # Храним только последние RAID_JOIN_THRESHOLD вступлений: всплеск — если самое старое из них в окне
+        now = time.time()
+        joins = self._joins.setdefault(chat_id, deque(maxlen=RAID_JOIN_THRESHOLD))
+        joins.append(now)
+        if len(joins) == RAID_JOIN_THRESHOLD and joins[0] >= now - RAID_JOIN_WINDOW:
+            if not self.is_active(chat_id):
+                self.raids += 1
+                logging.warning(f"[RAID] Рейд-режим в чате {chat_id}: {RAID_JOIN_THRESHOLD} вступлений за {now - joins[0]:.1f} сек")
+            self._raid_until[chat_id] = now + RAID_COOLDOWN
+        return self.is_active(chat_id)
+
+    async def on_join(self, bot, chat_id: int, user: types.User) -> bool:
+        # True — участник взят рейд-режимом, обычная обработка не нужна
+        if not self.record_join(chat_id):
+            return False
+        if not await db.have_stop_words(chat_id):
+            return False
+        if not await check_bot_permissions(bot, chat_id):
+            return False
+        await self.add_user(bot, chat_id, user)
+        return True
+
+    async def add_user(self, bot, chat_id: int, user: types.User):
+        batch = self._open.get(chat_id)
+        if batch is None or len(batch.users) >= RAID_BATCH_SIZE or batch.deadline - time.time() < batch.timeout / 2:
+            batch = RaidBatch(next(self._ids), chat_id, await db.get_captcha_timeout(chat_id))
+            self._open[chat_id] = batch
+            scheduler.schedule_at(batch.deadline, self._expire, bot, batch,
+                                  key=("raid_batch", chat_id, batch.batch_id))
+        self.users += 1
+        batch.users[user.id] = _mention(user)
+        batch.unsaved.append(user.id)
+        self._pending[(chat_id, user.id)] = batch
+        member_cache.set((chat_id, user.id), "restricted")
+        restrict_paced(bot, chat_id, user.id)
+        self._schedule_flush(bot, batch, RAID_FIRST_FLUSH if batch.message_id is None else RAID_EDIT_INTERVAL)
+
+    def forget(self, chat_id: int, user_id: int, bot=None) -> bool:
+        # Участник ответил, вышел или забанен — убираем из пачки и из очереди ограничений.
+        # True — ограничение ещё стояло в очереди и отменено, снимать его не нужно
+        cancelled = action_queue.cancel(chat_id, ("restrict", user_id))
+        batch = self._pending.pop((chat_id, user_id), None)
+        if batch is None:
+            return cancelled
+        batch.users.pop(user_id, None)
+        if user_id in batch.unsaved:
+            batch.unsaved.remove(user_id)
+        if bot is not None:
+            self._schedule_flush(bot, batch, RAID_EDIT_INTERVAL)
+        return cancelled
+
+    def _schedule_flush(self, bot, batch: RaidBatch, delay: float):
+        # Троттлинг, а не debounce: при непрерывной волне правка всё равно выходит раз в delay
+        if batch.flush_scheduled or batch.closed:
+            return
+        batch.flush_scheduled = True
+        scheduler.schedule(delay, self._flush, bot, batch, key=("raid_flush", batch.chat_id, batch.batch_id))
+
+    async def _flush(self, bot, batch: RaidBatch):
+        batch.flush_scheduled = False
+        if batch.closed:
+            return
+        if not batch.users:
+            await self._close(bot, batch)
+            return
+        try:
+            if batch.message_id is None:
+                message = await bot.send_message(batch.chat_id, batch.text(), reply_markup=batch.keyboard)
+                batch.message_id = message.message_id
+                self.messages += 1
+            else:
+                await bot.edit_message_text(batch.text(), batch.chat_id, batch.message_id, reply_markup=batch.keyboard)
+                self.edits += 1
+        except MessageNotModified:
+            pass
+        except RetryAfter as e:
+            batch.flush_scheduled = True
+            scheduler.schedule(e.timeout, self._flush, bot, batch, key=("raid_flush", batch.chat_id, batch.batch_id))
+            return
+        except TelegramAPIError as e:
+            logging.error(f"[RAID] Ошибка отправки общей капчи в чате {batch.chat_id}: {e}")
+        if batch.unsaved and batch.message_id:
+            user_ids, batch.unsaved = batch.unsaved, []
+            await db.add_captcha_batch(batch.chat_id, batch.message_id, user_ids, int(batch.deadline * 1000))
+
+    async def _close(self, bot, batch: RaidBatch):
+        # Все ответили или вышли — сообщение больше не нужно
+        batch.closed = True
+        self._drop_batch(batch)
+        scheduler.cancel(("raid_batch", batch.chat_id, batch.batch_id))
+        if batch.message_id:
+            try:
+                await bot.delete_message(batch.chat_id, batch.message_id)
+            except TelegramAPIError as e:
+                logging.warning(f"[RAID] Не удалось удалить общую капчу {batch.message_id}: {e}")
+
+    async def _expire(self, bot, batch: RaidBatch):
+        batch.closed = True
+        self._drop_batch(batch)
+        scheduler.cancel(("raid_flush", batch.chat_id, batch.batch_id))
+        if batch.message_id is None:
+            # Капчу так и не удалось показать — не держим людей под ограничением
+            for user_id in batch.users:
+                unrestrict_paced(bot, batch.chat_id, user_id)
+                member_cache.pop((batch.chat_id, user_id))
+            return
+        if batch.unsaved:
+            await db.add_captcha_batch(batch.chat_id, batch.message_id, batch.unsaved, int(batch.deadline * 1000))
+        await captcha_batch_timeout(bot, batch.chat_id, batch.message_id)
+
+    def _drop_batch(self, batch: RaidBatch):
+        if self._open.get(batch.chat_id) is batch:
+            del self._open[batch.chat_id]
+        for user_id in batch.users:
+            if self._pending.get((batch.chat_id, user_id)) is batch:
+                del self._pending[(batch.chat_id, user_id)]
+
+    async def answer(self, call: types.CallbackQuery, token: captcha_tokens.CaptchaToken):
+        chat_id = call.message.chat.id
+        user_id = call.from_user.id
+        batch = self._pending.get((chat_id, user_id))
+        if batch is not None:
+            mine = batch.message_id == call.message.message_id
+        else:
+            # После перезапуска пачек в памяти нет — сверяемся с базой
+            mine = (await db.get_captcha_message_id(user_id, chat_id) == call.message.message_id
+                    and not await db.check_captcha_status(user_id, chat_id))
+        if not mine:
+            await call.answer("Это не ваша капча!")
+            return
+
+        if token.correct:
+            await db.update_captcha_status(user_id, chat_id)
+            # Если ограничение ещё стоит в очереди — достаточно его отменить
+            if self.forget(chat_id, user_id, call.bot):
+                member_cache.set((chat_id, user_id), "member")
+            else:
+                await lift_restrictions(call.bot, chat_id, user_id)
+            await call.answer("Капча пройдена! Вы можете писать в чат.", show_alert=True)
+            return
+
+        attempts = await db.increment_captcha_attempts(user_id, chat_id)
+        if attempts < RAID_MAX_ATTEMPTS:
+            await call.answer(f"Неверно! Осталось попыток: {RAID_MAX_ATTEMPTS - attempts}")
+            return
+        self.forget(chat_id, user_id, call.bot)
+        ban_paced(call.bot, chat_id, user_id, int(time.time()) + 24 * 3600)
+        member_cache.set((chat_id, user_id), "kicked")
+        await db.delete_captcha_status(user_id, chat_id)
+        await call.answer("Превышено количество попыток. Вы забанены на 24 часа.", show_alert=True)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "active": sum(1 for chat_id in self._raid_until if self.is_active(chat_id)),
+            "raids": self.raids,
+            "users": self.users,
+            "messages": self.messages,
+            "edits": self.edits,
+        }
+
+
+raid_guard = RaidGuard()
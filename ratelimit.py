@@ -0,0 +1,88 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Iterable, List, Tuple
+
+from database import db
+
+SNAPSHOT_INTERVAL = 60
+
+
+# Состояние одного пользователя в чате: токены и момент, когда корзина снова полная
+class Bucket:
+    __slots__ = ("tokens", "updated", "full_at")
+
+    def __init__(self, tokens: float, updated: float, full_at: float):
+        self.tokens = tokens
+        self.updated = updated
+        self.full_at = full_at
+
+
+# Token bucket на (chat_id, user_id): capacity сообщений за period секунд,
+# capacity=1 — обычный кулдаун "одно сообщение раз в period секунд".
+# Полная корзина ничем не отличается от отсутствующей, поэтому такие записи выбрасываются
+class RateLimiter:
+    def __init__(self):
+        self._buckets: Dict[Tuple[int, int], Bucket] = {}
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def hit(self, chat_id: int, user_id: int, capacity: int, period: float) -> float:
+        # 0 — сообщение разрешено (токен списан), иначе сколько секунд ждать
+        now = time.time()
+        capacity = max(capacity, 1)
+        rate = capacity / period
+        bucket = self._buckets.get((chat_id, user_id))
+        if bucket is None:
+            tokens = float(capacity)
+        else:
+            tokens = min(capacity, bucket.tokens + (now - bucket.updated) * rate)
+        if tokens < 1:
+            return (1 - tokens) / rate
+        tokens -= 1
+        full_at = now + (capacity - tokens) / rate
+        if bucket is None:
+            self._buckets[(chat_id, user_id)] = Bucket(tokens, now, full_at)
+        else:
+            bucket.tokens, bucket.updated, bucket.full_at = tokens, now, full_at
+        return 0
+
+    def evict_idle(self) -> int:
+        now = time.time()
+        idle = [key for key, bucket in self._buckets.items() if bucket.full_at <= now]
+        for key in idle:
+            del self._buckets[key]
+        return len(idle)
+
+    def snapshot(self) -> List[Tuple[int, int, float, int, int]]:
+        return [(chat_id, user_id, bucket.tokens, int(bucket.updated * 1000), int(bucket.full_at * 1000))
+                for (chat_id, user_id), bucket in self._buckets.items()]
+
+    def restore(self, rows: Iterable[Tuple[int, int, float, int, int]]):
+        for chat_id, user_id, tokens, updated_ms, full_at_ms in rows:
+            self._buckets[(chat_id, user_id)] = Bucket(tokens, updated_ms / 1000, full_at_ms / 1000)
+
+
+rate_limiter = RateLimiter()
+
+
+async def restore_rate_limits():
+    rows = await db.load_rate_limits()
+    rate_limiter.restore(rows)
+    logging.info(f"Rate limiter restored: {len(rows)} buckets")
+
+
+async def save_rate_limits():
+    rate_limiter.evict_idle()
+    await db.save_rate_limits(rate_limiter.snapshot())
+
+
+async def run_snapshots(interval: float = SNAPSHOT_INTERVAL):
+    # Периодически выбрасываем полные корзины и сохраняем остальные в базу
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await save_rate_limits()
+        except Exception as e:
+            logging.error(f"Rate limiter snapshot failed: {e}")
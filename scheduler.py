@@ -0,0 +1,189 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+from aiogram import types
+from aiogram.utils.exceptions import RetryAfter
+
+# Сколько отложенных действий может выполняться одновременно
+MAX_CONCURRENT_ACTIONS = 20
+# Темп вызовов Bot API в одном чате через очередь action_queue
+PACED_ACTIONS_PER_SECOND = 5
+
+
+# Одна очередь отложенных действий на весь бот (куча по времени срабатывания)
+# вместо отдельной спящей корутины на каждое удаление/бан.
+# Действие можно отменить по ключу; повторное планирование с тем же ключом заменяет старое
+class Scheduler:
+    def __init__(self, max_concurrent: int = MAX_CONCURRENT_ACTIONS):
+        self.max_concurrent = max_concurrent
+        self._heap: List[Tuple[float, int]] = []
+        self._actions: Dict[int, Tuple[Callable, tuple, Optional[Hashable]]] = {}
+        self._keys: Dict[Hashable, int] = {}
+        self._ids = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self.executed = 0
+        self.failed = 0
+
+    @property
+    def depth(self) -> int:
+        return len(self._actions)
+
+    def schedule(self, delay: float, func: Callable, *args, key: Optional[Hashable] = None) -> int:
+        return self.schedule_at(time.time() + delay, func, *args, key=key)
+
+    def schedule_at(self, when: float, func: Callable, *args, key: Optional[Hashable] = None) -> int:
+        # when — время эпохи в секундах; func — корутинная функция
+        if key is not None:
+            self.cancel(key)
+        action_id = next(self._ids)
+        self._actions[action_id] = (func, args, key)
+        if key is not None:
+            self._keys[key] = action_id
+        heapq.heappush(self._heap, (when, action_id))
+        if self._wakeup is not None and self._heap[0][1] == action_id:
+            self._wakeup.set()
+        return action_id
+
+    def cancel(self, key: Hashable) -> bool:
+        # Запись в куче остаётся и пропускается при извлечении
+        action_id = self._keys.pop(key, None)
+        if action_id is None:
+            return False
+        self._actions.pop(action_id, None)
+        if len(self._heap) > 2 * len(self._actions) + 64:
+            self._heap = [item for item in self._heap if item[1] in self._actions]
+            heapq.heapify(self._heap)
+        return True
+
+    async def run(self):
+        self._wakeup = asyncio.Event()
+        self._slots = asyncio.Semaphore(self.max_concurrent)
+        while True:
+            self._wakeup.clear()
+            now = time.time()
+            while self._heap and self._heap[0][0] <= now:
+                _, action_id = heapq.heappop(self._heap)
+                action = self._actions.pop(action_id, None)
+                if action is None:
+                    continue
+                func, args, key = action
+                if key is not None and self._keys.get(key) == action_id:
+                    del self._keys[key]
+                await self._slots.acquire()
+                asyncio.create_task(self._execute(func, args))
+            timeout = self._heap[0][0] - time.time() if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _execute(self, func: Callable, args: tuple):
+        try:
+            await func(*args)
+            self.executed += 1
+        except Exception as e:
+            self.failed += 1
+            logging.error(f"[SCHEDULER] Ошибка отложенного действия {getattr(func, '__name__', func)}: {e}")
+        finally:
+            self._slots.release()
+
+
+scheduler = Scheduler()
+
+
+# Очередь вызовов Bot API по чатам в заданном темпе: волна вступлений превращается
+# в ровный поток restrict/ban вместо залпа, упирающегося во флуд-лимиты.
+# Действие с уже стоящим в очереди ключом не дублируется, ещё не выполненное можно отменить
+class ChatActionQueue:
+    def __init__(self, rate: float = PACED_ACTIONS_PER_SECOND):
+        self.rate = rate
+        self._queues: Dict[int, "OrderedDict[Hashable, Tuple[Callable, tuple]]"] = {}
+        self._workers: Dict[int, asyncio.Task] = {}
+        self.executed = 0
+        self.failed = 0
+        self.coalesced = 0
+
+    def __len__(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def put(self, chat_id: int, key: Hashable, func: Callable, *args) -> bool:
+        queue = self._queues.setdefault(chat_id, OrderedDict())
+        if key in queue:
+            queue[key] = (func, args)
+            self.coalesced += 1
+            return False
+        queue[key] = (func, args)
+        if chat_id not in self._workers:
+            self._workers[chat_id] = asyncio.create_task(self._drain(chat_id, queue))
+        return True
+
+    def cancel(self, chat_id: int, key: Hashable) -> bool:
+        queue = self._queues.get(chat_id)
+        return queue is not None and queue.pop(key, None) is not None
+
+    async def _drain(self, chat_id: int, queue: "OrderedDict[Hashable, Tuple[Callable, tuple]]"):
+        try:
+            while queue:
+                key, (func, args) = queue.popitem(last=False)
+                try:
+                    await func(*args)
+                    self.executed += 1
+                except RetryAfter as e:
+                    # Флуд-лимит касается только этого чата: возвращаем действие в голову очереди
+                    queue[key] = (func, args)
+                    queue.move_to_end(key, last=False)
+                    await asyncio.sleep(e.timeout)
+                    continue
+                except Exception as e:
+                    self.failed += 1
+                    logging.error(f"[SCHEDULER] Ошибка действия {key} в чате {chat_id}: {e}")
+                await asyncio.sleep(1 / self.rate)
+        finally:
+            del self._workers[chat_id]
+            if self._queues.get(chat_id) is queue and not queue:
+                del self._queues[chat_id]
+
+
+action_queue = ChatActionQueue()
+
+
+# ===================== Типовые действия =====================
+async def _delete_message(bot, chat_id: int, message_id: int):
+    await bot.delete_message(chat_id, message_id)
+
+
+async def _ban_user(bot, chat_id: int, user_id: int, until_date: Optional[int]):
+    await bot.ban_chat_member(chat_id, user_id, until_date=until_date)
+
+
+async def _restrict_user(bot, chat_id: int, user_id: int):
+    await bot.restrict_chat_member(
+        chat_id=chat_id,
+        user_id=user_id,
+        permissions=types.ChatPermissions(can_send_messages=False)
+    )
+
+
+def delete_message_later(bot, chat_id: int, message_id: int, delay: float) -> int:
+    return scheduler.schedule(delay, _delete_message, bot, chat_id, message_id,
+                              key=("delete", chat_id, message_id))
+
+
+# Варианты через очередь с темпом; бан отменяет ещё не выполненное ограничение
+def restrict_paced(bot, chat_id: int, user_id: int) -> bool:
+    return action_queue.put(chat_id, ("restrict", user_id), _restrict_user, bot, chat_id, user_id)
+
+
+def delete_message_paced(bot, chat_id: int, message_id: int) -> bool:
+    return action_queue.put(chat_id, ("delete", message_id), _delete_message, bot, chat_id, message_id)
+
+
+def ban_paced(bot, chat_id: int, user_id: int, until_date: Optional[int] = None) -> bool:
+    action_queue.cancel(chat_id, ("restrict", user_id))
+    return action_queue.put(chat_id, ("ban", user_id), _ban_user, bot, chat_id, user_id, until_date)
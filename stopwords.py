@@ -0,0 +1,169 @@
+import asyncio
+import logging
+import re
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Символ переходов автомата кодируется в ключ state * CHAR_SPACE + ord(char):
+# один общий dict вместо словаря на каждый узел — так 100k слов помещаются в память
+CHAR_SPACE = 0x110000
+WORD_RE = re.compile(r"\w+", flags=re.UNICODE)
+
+
+def _is_word_char(ch: str) -> bool:
+    return ch.isalnum() or ch == "_"
+
+
+def _normalize(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+# Автомат Ахо–Корасик для шаблонов-подстрок: текст сканируется один раз,
+# время не зависит от числа шаблонов
+class SubstringAutomaton:
+    def __init__(self, patterns: Iterable[Tuple[str, bool, bool]]):
+        # (текст, длина, граница слева, граница справа)
+        self.patterns: List[Tuple[str, int, bool, bool]] = []
+        self._goto: Dict[int, int] = {}
+        self._fail: List[int] = [0]
+        # Номера шаблонов, заканчивающихся в узле, и ближайший по fail-цепочке узел с шаблонами
+        self._out: Dict[int, List[int]] = {}
+        self._out_link: List[int] = [0]
+        self._build(patterns)
+
+    def __len__(self) -> int:
+        return len(self.patterns)
+
+    def _build(self, patterns: Iterable[Tuple[str, bool, bool]]):
+        children: List[List[Tuple[str, int]]] = [[]]
+        for text, left, right in patterns:
+            state = 0
+            for ch in text:
+                key = state * CHAR_SPACE + ord(ch)
+                nxt = self._goto.get(key)
+                if nxt is None:
+                    nxt = len(self._fail)
+                    self._goto[key] = nxt
+                    self._fail.append(0)
+                    self._out_link.append(0)
+                    children.append([])
+                    children[state].append((ch, nxt))
+                state = nxt
+            self._out.setdefault(state, []).append(len(self.patterns))
+            self.patterns.append((text, len(text), left, right))
+
+        # Обход в ширину: fail-ссылки и ссылки на ближайший узел с выходом
+        queue = [child for _, child in children[0]]
+        for state in queue:
+            for ch, child in children[state]:
+                queue.append(child)
+                fallback = self._fail[state]
+                while True:
+                    nxt = self._goto.get(fallback * CHAR_SPACE + ord(ch))
+                    if nxt is not None and nxt != child:
+                        self._fail[child] = nxt
+                        break
+                    if fallback == 0:
+                        break
+                    fallback = self._fail[fallback]
+                fail = self._fail[child]
+                self._out_link[child] = fail if fail in self._out else self._out_link[fail]
+
+    def search(self, text: str) -> Optional[str]:
+        goto = self._goto
+        fail = self._fail
+        out = self._out
+        out_link = self._out_link
+        length = len(text)
+        state = 0
+        for i, ch in enumerate(text):
+            code = ord(ch)
+            while True:
+                nxt = goto.get(state * CHAR_SPACE + code)
+                if nxt is not None:
+                    state = nxt
+                    break
+                if state == 0:
+                    break
+                state = fail[state]
+            match_state = state if state in out else out_link[state]
+            while match_state:
+                for index in out[match_state]:
+                    pattern, size, left, right = self.patterns[index]
+                    start = i - size + 1
+                    if left and start > 0 and _is_word_char(text[start - 1]):
+                        continue
+                    if right and i + 1 < length and _is_word_char(text[i + 1]):
+                        continue
+                    return pattern
+                match_state = out_link[match_state]
+        return None
+
+
+# Скомпилированный список стоп-слов.
+# Слова и фразы из букв/цифр ищутся целиком: текст один раз режется на слова,
+# а n-граммы проверяются по frozenset — стоимость не зависит от размера списка.
+# Всё остальное ("*" в начале/конце снимает границу слова с этой стороны,
+# "*казино*" — подстрока где угодно; записи со знаками вроде "c++") идёт в автомат
+class StopWordMatcher:
+    def __init__(self, words: Iterable[str] = (), version: int = 0):
+        self.version = version
+        phrases = set()
+        substrings = set()
+        for word in words:
+            raw = word.strip()
+            left = not raw.startswith("*")
+            right = not raw.endswith("*")
+            text = _normalize(raw.strip("*"))
+            if not text:
+                continue
+            if left and right and " ".join(WORD_RE.findall(text)) == text:
+                phrases.add(text)
+            else:
+                substrings.add((text, left, right))
+        self.phrases = frozenset(phrases)
+        self.max_phrase_words = max((p.count(" ") + 1 for p in phrases), default=0)
+        self.automaton = SubstringAutomaton(sorted(substrings)) if substrings else None
+
+    def __len__(self) -> int:
+        return len(self.phrases) + (len(self.automaton) if self.automaton else 0)
+
+    def search(self, text: str) -> Optional[str]:
+        # Возвращает первое найденное стоп-слово или None
+        if not text:
+            return None
+        text = text.lower()
+        if self.phrases:
+            phrases = self.phrases
+            words = WORD_RE.findall(text)
+            if self.max_phrase_words == 1:
+                for word in words:
+                    if word in phrases:
+                        return word
+            else:
+                for i in range(len(words)):
+                    for size in range(1, min(self.max_phrase_words, len(words) - i) + 1):
+                        candidate = " ".join(words[i:i + size])
+                        if candidate in phrases:
+                            return candidate
+        if self.automaton:
+            return self.automaton.search(_normalize(text))
+        return None
+
+
+# Текущий набор стоп-слов; заменяется целиком одной операцией присваивания
+matcher = StopWordMatcher()
+
+
+def find_stop_word(text: str) -> Optional[str]:
+    return matcher.search(text)
+
+
+async def reload_stop_words(words: Iterable[str]) -> StopWordMatcher:
+    # Строим новый автомат в пуле потоков и атомарно подменяем старый
+    global matcher
+    words = list(words)
+    loop = asyncio.get_running_loop()
+    new_matcher = await loop.run_in_executor(None, StopWordMatcher, words, matcher.version + 1)
+    matcher = new_matcher
+    logging.info(f"Stop words matcher v{new_matcher.version} loaded: {len(new_matcher)} patterns")
+    return new_matcher
@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+# Модули бота лежат в корне репозитория; bot.db и bot.log тестов — во временном каталоге
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(tempfile.mkdtemp(prefix="bot-tests-"))
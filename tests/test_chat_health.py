@@ -0,0 +1,49 @@
+import asyncio
+
+from aiogram.utils.exceptions import BadRequest, BotKicked, ChatNotFound, Unauthorized
+
+import chat_health
+from chat_health import ChatHealth
+from database import ChatSettings
+
+
+class FakeDb:
+    def __init__(self, chat_ids):
+        self.chats = {chat_id: ChatSettings(chat_id) for chat_id in chat_ids}
+
+    async def get_chat(self, chat_id):
+        return self.chats.get(chat_id)
+
+    async def update_chat_settings(self, chat_id, **kwargs):
+        self.chats[chat_id] = self.chats[chat_id]._replace(**kwargs)
+
+
+# Ошибки по чатам; чатов без ошибки нет в словаре — туда отправка проходит
+ERRORS = {
+    -1: Unauthorized("Forbidden: bot is not a member of the supergroup chat"),
+    -2: Unauthorized("Unauthorized"),
+    -3: ChatNotFound("Chat not found"),
+    -5: BotKicked("Forbidden: bot was kicked from the supergroup chat"),
+    -6: BadRequest("Not enough rights to send text messages to the chat"),
+}
+
+
+def test_mixed_failures_are_all_reported(monkeypatch):
+    chat_ids = [-1, -2, -3, -4, -5, -6]
+    db = FakeDb(chat_ids)
+    monkeypatch.setattr(chat_health, "db", db)
+    health = ChatHealth()
+
+    async def action(chat_id):
+        if chat_id in ERRORS:
+            raise ERRORS[chat_id]
+        return chat_id
+
+    result = asyncio.run(health.run(chat_ids, action))
+
+    assert set(result.sent) == {-4}
+    assert set(result.failed) == set(ERRORS)
+    # 403 "not a member", ChatNotFound и BotKicked гасят чат; 401 токена и нехватка прав — нет
+    inactive = {chat_id for chat_id, settings in db.chats.items() if not settings.is_active}
+    assert inactive == {-1, -3, -5}
+    assert health.deactivated == 3
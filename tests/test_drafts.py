@@ -0,0 +1,62 @@
+import asyncio
+
+from aiogram import types
+from aiogram.utils.exceptions import BadRequest, ChatNotFound
+
+from drafts import PostDraft
+
+
+def _text_message() -> types.Message:
+    return types.Message.to_object({
+        "message_id": 7, "date": 0, "text": "пост",
+        "chat": {"id": -100, "type": "supergroup"},
+    })
+
+
+class FakeBot:
+    def __init__(self, missing_chats=(), source_deleted=False):
+        self.missing_chats = set(missing_chats)
+        self.source_deleted = source_deleted
+        self.calls = []
+
+    async def copy_message(self, chat_id, **kwargs):
+        self.calls.append(("copy_message", chat_id))
+        if chat_id in self.missing_chats:
+            raise ChatNotFound("Chat not found")
+        if self.source_deleted:
+            raise BadRequest("Message to copy not found")
+        return types.MessageId(message_id=1)
+
+    async def send_message(self, chat_id, **kwargs):
+        self.calls.append(("send_message", chat_id))
+        return types.MessageId(message_id=2)
+
+
+def test_missing_target_chat_keeps_copy_path():
+    bot = FakeBot(missing_chats={-999})
+    draft = PostDraft.from_messages([_text_message()])
+
+    async def run():
+        for chat_id in (-999, -5, -6):
+            try:
+                await draft.send(bot, chat_id)
+            except ChatNotFound:
+                pass
+
+    asyncio.run(run())
+    assert bot.calls == [("copy_message", -999), ("copy_message", -5), ("copy_message", -6)]
+    assert draft.method == "copy_message"
+    assert draft.to_dict()["method"] == "copy_message"
+
+
+def test_deleted_source_switches_to_fallback():
+    bot = FakeBot(source_deleted=True)
+    draft = PostDraft.from_messages([_text_message()])
+
+    async def run():
+        await draft.send(bot, -5)
+        await draft.send(bot, -6)
+
+    asyncio.run(run())
+    assert bot.calls == [("copy_message", -5), ("send_message", -5), ("send_message", -6)]
+    assert draft.to_dict()["method"] == "send_message"
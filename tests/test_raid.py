@@ -0,0 +1,129 @@
+import asyncio
+import time
+
+from aiogram import types
+
+import raid
+from scheduler import Scheduler, action_queue
+from utils import FULL_PERMISSIONS, unrestrict_paced
+
+# Темп очереди в тесте выше боевого, чтобы волна разбиралась за доли секунды
+RATE = 100
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+        self.edits = 0
+        self.restricts = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+        return types.Message(message_id=len(self.sent), chat=types.Chat(id=chat_id, type="supergroup"))
+
+    async def edit_message_text(self, *args, **kwargs):
+        self.edits += 1
+
+    async def restrict_chat_member(self, chat_id, user_id, permissions):
+        self.restricts.append((time.monotonic(), user_id, permissions))
+
+
+class FakeDb:
+    def __init__(self):
+        self.batches = []
+
+    async def have_stop_words(self, chat_id):
+        return True
+
+    async def get_captcha_timeout(self, chat_id):
+        return 300
+
+    async def add_captcha_batch(self, chat_id, message_id, user_ids, deadline_ms):
+        self.batches.append((message_id, list(user_ids)))
+
+
+async def _allowed(bot, chat_id):
+    return True
+
+
+def _user(user_id: int) -> types.User:
+    return types.User(id=user_id, is_bot=False, first_name=f"u{user_id}", username=f"user{user_id}")
+
+
+async def _wait_drained(chat_id: int):
+    while chat_id in action_queue._queues:
+        await asyncio.sleep(0.01)
+
+
+def test_join_burst_shares_one_captcha_and_paces_restricts(monkeypatch):
+    db = FakeDb()
+    monkeypatch.setattr(raid, "db", db)
+    monkeypatch.setattr(raid, "check_bot_permissions", _allowed)
+    monkeypatch.setattr(raid, "scheduler", Scheduler())
+    monkeypatch.setattr(raid, "RAID_FIRST_FLUSH", 0.05)
+    monkeypatch.setattr(action_queue, "rate", RATE)
+    guard = raid.RaidGuard()
+    bot = FakeBot()
+    chat_id = -100
+    joins = 40
+
+    async def run():
+        runner = asyncio.create_task(raid.scheduler.run())
+        taken = [await guard.on_join(bot, chat_id, _user(user_id)) for user_id in range(1, joins + 1)]
+        await asyncio.sleep(0.2)
+        await _wait_drained(chat_id)
+        runner.cancel()
+        return taken
+
+    taken = asyncio.run(run())
+
+    # До порога вступления идут обычным путём, остальные — в рейд-режим
+    raided = list(range(raid.RAID_JOIN_THRESHOLD, joins + 1))
+    assert taken == [False] * (raid.RAID_JOIN_THRESHOLD - 1) + [True] * len(raided)
+    assert len(bot.sent) == 1
+    assert all(f"@user{user_id}" in bot.sent[0][1] for user_id in raided)
+    assert db.batches == [(1, raided)]
+
+    assert [user_id for _, user_id, _ in bot.restricts] == raided
+    assert all(not permissions.can_send_messages for _, _, permissions in bot.restricts)
+    gaps = [b[0] - a[0] for a, b in zip(bot.restricts, bot.restricts[1:])]
+    assert min(gaps) >= 0.9 / RATE
+
+
+def test_leaving_member_is_not_restricted(monkeypatch):
+    monkeypatch.setattr(raid, "db", FakeDb())
+    monkeypatch.setattr(raid, "check_bot_permissions", _allowed)
+    monkeypatch.setattr(raid, "scheduler", Scheduler())
+    monkeypatch.setattr(action_queue, "rate", RATE)
+    guard = raid.RaidGuard()
+    bot = FakeBot()
+    chat_id = -300
+    left = raid.RAID_JOIN_THRESHOLD + 2
+
+    async def run():
+        for user_id in range(1, raid.RAID_JOIN_THRESHOLD + 5):
+            await guard.on_join(bot, chat_id, _user(user_id))
+        # Выход участника (handlers/common.py) — ограничение ещё в очереди
+        guard.forget(chat_id, left)
+        await _wait_drained(chat_id)
+
+    asyncio.run(run())
+
+    restricted = [user_id for _, user_id, _ in bot.restricts]
+    assert left not in restricted
+    assert restricted == [user_id for user_id in range(raid.RAID_JOIN_THRESHOLD, raid.RAID_JOIN_THRESHOLD + 5)
+                          if user_id != left]
+    assert not guard.is_pending(chat_id, left)
+
+
+def test_unrestrict_lifts_full_permissions(monkeypatch):
+    monkeypatch.setattr(action_queue, "rate", RATE)
+    bot = FakeBot()
+
+    async def run():
+        unrestrict_paced(bot, -200, 1)
+        await _wait_drained(-200)
+
+    asyncio.run(run())
+
+    assert [permissions for _, _, permissions in bot.restricts] == [FULL_PERMISSIONS]
@@ -2,14 +2,63 @@ import asyncio
 import logging
 import random
 import re
+import time
+from collections import deque
 from datetime import datetime, timedelta
+from typing import Dict, Optional, Tuple
 
 from aiogram import types
+from aiogram.utils.exceptions import NetworkError, RestartingTelegram, RetryAfter, TelegramAPIError
 
-import database
+from cache import bot_rights_cache, member_cache
+from database import db
 from keyboards import get_captcha_keyboard
+from scheduler import scheduler, action_queue, ban_paced, delete_message_later, delete_message_paced
 
-db = database.MainDb()
+# Снятие ограничений: число попыток и базовая пауза экспоненциального повтора
+LIFT_MAX_ATTEMPTS = 4
+LIFT_BACKOFF_BASE = 0.5
+# Сколько ждать обновления chat_member, подтверждающего снятие
+LIFT_CONFIRM_TIMEOUT = 30
+# Права, без которых бот не работает в чате; неудачная проверка прав кэшируется ненадолго
+REQUIRED_BOT_RIGHTS = ("can_delete_messages", "can_restrict_members", "can_pin_messages", "can_manage_chat")
+BOT_RIGHTS_ERROR_TTL = 60
+
+FULL_PERMISSIONS = types.ChatPermissions(
+    can_send_messages=True,
+    can_send_media_messages=True,
+    can_send_polls=True,
+    can_send_other_messages=True,
+    can_add_web_page_previews=True,
+    can_change_info=True,
+    can_invite_users=True,
+    can_pin_messages=True
+)
+
+
+# Перцентиль q (0..1) по окну задержек для /bot_stats; пустое окно — 0
+def percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+
+# Метрики снятия ограничений для /bot_stats; задержки в секундах
+class LiftStats:
+    def __init__(self, window: int = 1000):
+        self.lifted = 0
+        self.failed = 0
+        self.retries = 0
+        self.confirmed = 0
+        self.unconfirmed = 0
+        self.call_latencies = deque(maxlen=window)
+        self.confirm_latencies = deque(maxlen=window)
+
+
+lift_stats = LiftStats()
+# (chat_id, user_id) -> момент вызова restrict, пока не пришло подтверждение
+_awaiting_confirmation: Dict[Tuple[int, int], float] = {}
 
 
 # Генерация простой капчи
@@ -22,59 +71,210 @@ def generate_captcha():
     return question, answer
 
 
-# Проверка прав бота
+# Проверка прав бота: локальный поиск в bot_rights_cache, get_chat_member — только
+# при первом обращении к чату и после истечения TTL
+def missing_bot_rights(member) -> list:
+    if not member:
+        return list(REQUIRED_BOT_RIGHTS)
+    return [right for right in REQUIRED_BOT_RIGHTS if not getattr(member, right, False)]
+
+
+def update_bot_rights(chat_id: int, member: types.ChatMember):
+    bot_rights_cache.set(chat_id, member)
+
+
+async def get_bot_rights(bot, chat_id: int):
+    member = bot_rights_cache.get(chat_id)
+    if member is None:
+        try:
+            member = await bot.get_chat_member(chat_id, bot.id)
+            bot_rights_cache.set(chat_id, member)
+        except Exception as e:
+            logging.error(f"[ERROR] Не удалось проверить права бота в чате {chat_id}: {e}")
+            member = False
+            bot_rights_cache.set(chat_id, member, ttl=BOT_RIGHTS_ERROR_TTL)
+    return member
+
+
 async def check_bot_permissions(bot, chat_id: int) -> bool:
+    return not missing_bot_rights(await get_bot_rights(bot, chat_id))
+
+
+# Статус участника с кэшем: повторные запросы в пределах TTL не ходят в Bot API
+async def get_member_status(bot, chat_id: int, user_id: int) -> str:
+    status = member_cache.get((chat_id, user_id))
+    if status is None:
+        member = await bot.get_chat_member(chat_id, user_id)
+        status = member.status
+        member_cache.set((chat_id, user_id), status)
+    return status
+
+
+# Снятие ограничений: один вызов restrict_chat_member, повтор с экспоненциальной
+# паузой только при RetryAfter и сетевых ошибках. Вместо опроса get_chat_member
+# результат подтверждается обновлением chat_member (см. confirm_restrictions_lifted)
+async def lift_restrictions(bot, chat_id: int, user_id: int) -> bool:
+    started = time.monotonic()
+    for attempt in range(LIFT_MAX_ATTEMPTS):
+        try:
+            await bot.restrict_chat_member(chat_id=chat_id, user_id=user_id, permissions=FULL_PERMISSIONS)
+            break
+        except RetryAfter as e:
+            delay = e.timeout
+        except (NetworkError, RestartingTelegram, asyncio.TimeoutError) as e:
+            delay = LIFT_BACKOFF_BASE * 2 ** attempt
+            logging.warning(f"[CAPTCHA] Сбой снятия ограничений user={user_id} (попытка {attempt+1}): {e}")
+        except TelegramAPIError as e:
+            # Нет прав, пользователь не найден и т.п. — повтор не поможет
+            lift_stats.failed += 1
+            logging.error(f"[ERROR] Ошибка снятия ограничений user={user_id} chat={chat_id}: {e}")
+            return False
+        if attempt + 1 < LIFT_MAX_ATTEMPTS:
+            lift_stats.retries += 1
+            await asyncio.sleep(delay)
+    else:
+        lift_stats.failed += 1
+        logging.error(f"[ERROR] Не удалось снять ограничения user={user_id} chat={chat_id} за {LIFT_MAX_ATTEMPTS} попыток")
+        return False
+
+    # Забаненного (например, по таймауту капчи) дополнительно разбаниваем
+    if member_cache.get((chat_id, user_id)) == "kicked":
+        try:
+            await bot.unban_chat_member(chat_id, user_id, only_if_banned=True)
+        except TelegramAPIError as e:
+            logging.error(f"[ERROR] Unban не удался user={user_id} chat={chat_id}: {e}")
+
+    lift_stats.lifted += 1
+    lift_stats.call_latencies.append(time.monotonic() - started)
+    member_cache.set((chat_id, user_id), "member")
+    _awaiting_confirmation[(chat_id, user_id)] = started
+    scheduler.schedule(LIFT_CONFIRM_TIMEOUT, _confirmation_timeout, chat_id, user_id,
+                       key=("lift_confirm", chat_id, user_id))
+    logging.info(f"[CAPTCHA] Ограничения сняты: user={user_id}")
+    return True
+
+
+# Вызывается из обработчика chat_member: фиксирует задержку до подтверждения от Telegram
+def confirm_restrictions_lifted(chat_id: int, user_id: int, member: types.ChatMember) -> bool:
+    started = _awaiting_confirmation.get((chat_id, user_id))
+    if started is None:
+        return False
+    if member.status != "member" and not (member.status == "restricted" and member.can_send_messages):
+        return False
+    del _awaiting_confirmation[(chat_id, user_id)]
+    scheduler.cancel(("lift_confirm", chat_id, user_id))
+    lift_stats.confirmed += 1
+    lift_stats.confirm_latencies.append(time.monotonic() - started)
+    return True
+
+
+async def _confirmation_timeout(chat_id: int, user_id: int):
+    if _awaiting_confirmation.pop((chat_id, user_id), None) is not None:
+        lift_stats.unconfirmed += 1
+        logging.warning(f"[CAPTCHA] Нет подтверждения снятия ограничений user={user_id} chat={chat_id}")
+
+
+async def _unrestrict_user(bot, chat_id: int, user_id: int):
+    await bot.restrict_chat_member(chat_id=chat_id, user_id=user_id, permissions=FULL_PERMISSIONS)
+
+
+# Снятие через очередь с темпом (action_queue); ещё не выполненное ограничение отменяется
+def unrestrict_paced(bot, chat_id: int, user_id: int) -> bool:
+    action_queue.cancel(chat_id, ("restrict", user_id))
+    return action_queue.put(chat_id, ("unrestrict", user_id), _unrestrict_user, bot, chat_id, user_id)
+
+
+# Таймаут капчи: если не пройдена — удаляем капчу и баним на 24 часа
+async def captcha_timeout(bot, chat_id: int, user_id: int, message_id: Optional[int], username: Optional[str]):
+    if await db.check_captcha_status(user_id, chat_id):
+        return
+    if message_id:
+        try:
+            await bot.delete_message(chat_id, message_id)
+        except:
+            pass
+
     try:
-        bot_member = await bot.get_chat_member(chat_id, bot.id)
-        return (
-            bot_member.can_delete_messages
-            and bot_member.can_restrict_members
-            and bot_member.can_pin_messages
-            and bot_member.can_manage_chat
+        await bot.ban_chat_member(
+            chat_id,
+            user_id,
+            until_date=int((datetime.now() + timedelta(hours=24)).timestamp())
+        )
+        member_cache.set((chat_id, user_id), "kicked")
+        # После перезапуска имени нет — упоминаем по id
+        mention = f"@{username}" if username else f'<a href="tg://user?id={user_id}">Пользователь</a>'
+        ban_msg = await bot.send_message(
+            chat_id, f"{mention} забанен на 24 часа за непрохождение капчи."
         )
+        delete_message_later(bot, chat_id, ban_msg.message_id, 10)
     except Exception as e:
-        logging.error(f"[ERROR] Не удалось проверить права бота в чате {chat_id}: {e}")
-        return False
+        logging.error(f"[ERROR] Ошибка при бане: {e}")
 
+    await db.delete_captcha_status(user_id, chat_id)
 
-# Снятие ограничений
-async def lift_restrictions(bot, chat_id: int, user_id: int):
-    for attempt in range(3):
-        try:
-            await bot.restrict_chat_member(
-                chat_id=chat_id,
-                user_id=user_id,
-                permissions=types.ChatPermissions(
-                    can_send_messages=True,
-                    can_send_media_messages=True,
-                    can_send_polls=True,
-                    can_send_other_messages=True,
-                    can_add_web_page_previews=True,
-                    can_change_info=True,
-                    can_invite_users=True,
-                    can_pin_messages=True
-                )
-            )
-            await asyncio.sleep(2)
-            member = await bot.get_chat_member(chat_id, user_id)
-            if member.status == "member":
-                logging.info(f"[CAPTCHA] Ограничения сняты: user={user_id}")
-                return True
-        except Exception as e:
-            logging.error(f"[ERROR] Ошибка снятия ограничений (попытка {attempt+1}): {e}")
-            await asyncio.sleep(2)
 
-    # Пробуем unban
+def cancel_captcha_timeout(chat_id: int, user_id: int) -> bool:
+    return scheduler.cancel(("captcha", chat_id, user_id))
+
+
+# Таймаут общей капчи рейд-режима: одно удаление сообщения, баны через очередь
+# с темпом и одно уведомление на всех, кто не успел ответить
+async def captcha_batch_timeout(bot, chat_id: int, message_id: int):
+    user_ids = await db.get_batch_captcha_users(chat_id, message_id)
     try:
-        await bot.unban_chat_member(chat_id, user_id, only_if_banned=True)
-        await asyncio.sleep(2)
-        member = await bot.get_chat_member(chat_id, user_id)
-        if member.status == "member":
-            return True
+        await bot.delete_message(chat_id, message_id)
+    except Exception as e:
+        logging.warning(f"[CAPTCHA] Не удалось удалить общую капчу {message_id}: {e}")
+    if not user_ids:
+        return
+    until_date = int((datetime.now() + timedelta(hours=24)).timestamp())
+    for user_id in user_ids:
+        ban_paced(bot, chat_id, user_id, until_date)
+        member_cache.set((chat_id, user_id), "kicked")
+    try:
+        notice = await bot.send_message(
+            chat_id, f"Не прошли капчу и забанены на 24 часа: {len(user_ids)} участников."
+        )
+        delete_message_later(bot, chat_id, notice.message_id, 10)
     except Exception as e:
-        logging.error(f"[ERROR] Unban не помог: {e}")
+        logging.error(f"[ERROR] Ошибка уведомления о банах: {e}")
+    await db.delete_captcha_statuses(chat_id, user_ids)
+
 
-    return False
+# Восстановление таймаутов капчи после перезапуска. Просроченные за время простоя удаляются
+# из базы одним запросом, их баны и удаление сообщений уходят в очередь с темпом (action_queue)
+# и не занимают слоты планировщика. В планировщик попадают только сроки в будущем;
+# капчи с общим сообщением (рейд-режим) получают один таймаут на всю пачку
+async def restore_captcha_deadlines(bot) -> int:
+    expired = await db.pop_expired_captchas(int(time.time() * 1000))
+    until_date = int((datetime.now() + timedelta(hours=24)).timestamp())
+    # Сначала убираем сообщения капчи, баны встают в очередь чата за ними
+    for chat_id, message_id in {(chat_id, message_id) for _, chat_id, message_id in expired if message_id}:
+        delete_message_paced(bot, chat_id, message_id)
+    for user_id, chat_id, _ in expired:
+        ban_paced(bot, chat_id, user_id, until_date)
+        member_cache.set((chat_id, user_id), "kicked")
+
+    pending = await db.get_pending_captchas()
+    batch_sizes: Dict[Tuple[int, int], int] = {}
+    for user_id, chat_id, message_id, deadline_ms in pending:
+        if message_id:
+            batch_sizes[(chat_id, message_id)] = batch_sizes.get((chat_id, message_id), 0) + 1
+    restored_batches = set()
+    for user_id, chat_id, message_id, deadline_ms in pending:
+        batch = (chat_id, message_id)
+        if batch in restored_batches:
+            continue
+        when = deadline_ms / 1000
+        if batch_sizes.get(batch, 0) > 1:
+            restored_batches.add(batch)
+            scheduler.schedule_at(when, captcha_batch_timeout, bot, chat_id, message_id,
+                                  key=("captcha_batch", chat_id, message_id))
+        else:
+            scheduler.schedule_at(when, captcha_timeout, bot, chat_id, user_id, message_id, None,
+                                  key=("captcha", chat_id, user_id))
+    logging.info(f"[CAPTCHA] Восстановлено таймаутов капчи: {len(pending)}, просроченных: {len(expired)}")
+    return len(pending) + len(expired)
 
 
 # Отправка капчи
@@ -82,7 +282,7 @@ async def send_captcha(bot, update: types.Message | types.ChatMemberUpdated, use
     logging.info(f"[CAPTCHA] Запрос отправки капчи user={user_id} chat={chat_id}")
 
     # Проверяем: включены ли стоп-слова
-    if not db.have_stop_words(chat_id):
+    if not await db.have_stop_words(chat_id):
         return
 
     # Проверяем права бота
@@ -96,8 +296,7 @@ async def send_captcha(bot, update: types.Message | types.ChatMemberUpdated, use
 
     # 🔥 Проверяем: пользователь всё ещё в чате!
     try:
-        member = await bot.get_chat_member(chat_id, user_id)
-        if member.status in ["left", "kicked", "banned"]:
+        if await get_member_status(bot, chat_id, user_id) in ["left", "kicked", "banned"]:
             logging.info(
                 f"[CAPTCHA] Пользователь {user_id} уже не в чате {chat_id}. Капча НЕ отправляется."
             )
@@ -116,9 +315,11 @@ async def send_captcha(bot, update: types.Message | types.ChatMemberUpdated, use
     question, correct_answer = generate_captcha()
 
     # Увеличиваем попытки (только здесь! НЕ ДВА РАЗА)
-    attempts = db.increment_captcha_attempts(user_id, chat_id)
+    attempts = await db.increment_captcha_attempts(user_id, chat_id)
     attempts_left = 3 - attempts
 
+    deadline = time.time() + await db.get_captcha_timeout(chat_id)
+
     try:
         # Отправляем капчу
         captcha_message = await bot.send_message(
@@ -126,11 +327,11 @@ async def send_captcha(bot, update: types.Message | types.ChatMemberUpdated, use
             f"@{username}, пройдите капчу, чтобы писать в чат:\n"
             f"{question}\n"
             f"Осталось попыток: {attempts_left}\n"
-            f"Капча исчезнет через {db.get_captcha_timeout(chat_id)} секунд.",
-            reply_markup=get_captcha_keyboard(correct_answer, chat_id, user_id)
+            f"Капча исчезнет через {await db.get_captcha_timeout(chat_id)} секунд.",
+            reply_markup=get_captcha_keyboard(correct_answer, chat_id, user_id, int(deadline))
         )
 
-        db.update_captcha_message_id(user_id, chat_id, captcha_message.message_id)
+        await db.update_captcha_message_id(user_id, chat_id, captcha_message.message_id, int(deadline * 1000))
         await state.update_data(captcha_message_id=captcha_message.message_id)
 
         # Ограничиваем пользователя
@@ -139,35 +340,12 @@ async def send_captcha(bot, update: types.Message | types.ChatMemberUpdated, use
             user_id=user_id,
             permissions=types.ChatPermissions(can_send_messages=False)
         )
+        member_cache.set((chat_id, user_id), "restricted")
 
-        # Автоудаление по таймауту
-        async def timeout_task():
-            await asyncio.sleep(db.get_captcha_timeout(chat_id))
-
-            # Если капча не пройдена — бан
-            if not db.check_captcha_status(user_id, chat_id):
-                try:
-                    await bot.delete_message(chat_id, captcha_message.message_id)
-                except:
-                    pass
-
-                try:
-                    await bot.ban_chat_member(
-                        chat_id,
-                        user_id,
-                        until_date=int((datetime.now() + timedelta(hours=24)).timestamp())
-                    )
-                    ban_msg = await bot.send_message(
-                        chat_id, f"@{username} забанен на 24 часа за непрохождение капчи."
-                    )
-                    await asyncio.sleep(10)
-                    await bot.delete_message(chat_id, ban_msg.message_id)
-                except Exception as e:
-                    logging.error(f"[ERROR] Ошибка при бане: {e}")
-
-                db.delete_captcha_status(user_id, chat_id)
-
-        asyncio.create_task(timeout_task())
+        # Автоудаление по таймауту — через общий планировщик, отменяется при прохождении капчи
+        scheduler.schedule_at(deadline, captcha_timeout,
+                              bot, chat_id, user_id, captcha_message.message_id, username,
+                              key=("captcha", chat_id, user_id))
 
     except Exception as e:
         logging.error(f"[ERROR] Ошибка отправки капчи: {e}")
\ No newline at end of file
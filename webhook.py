@@ -0,0 +1,134 @@
+import asyncio
+import hashlib
+import hmac
+import logging
+import time
+from collections import deque
+
+from aiogram import Bot, Dispatcher, types
+from aiogram.dispatcher.webhook import WebhookRequestHandler
+from aiogram.utils.executor import Executor
+from aiohttp import web
+
+from config import TOKEN, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_MAX_CONNECTIONS, WEBAPP_HOST, \
+    WEBAPP_PORT, UPDATE_QUEUE_SIZE, UPDATE_WORKERS
+from utils import percentile
+
+# Секрет заголовка X-Telegram-Bot-Api-Secret-Token: из конфига или выводится из токена (A-Z, a-z, 0-9, _ и -)
+SECRET_TOKEN = WEBHOOK_SECRET or hashlib.sha256(b"webhook-secret:" + TOKEN.encode()).hexdigest()
+# Сколько ждать разбора очереди при остановке
+DRAIN_TIMEOUT = 10
+
+
+# Очередь входящих обновлений: HTTP-запрос Telegram только кладёт обновление и сразу
+# получает 200, обработку ведут UPDATE_WORKERS воркеров. Очередь ограничена: при
+# переполнении отвечаем 503, и Telegram сам доставит обновление позже
+class UpdateQueue:
+    def __init__(self, maxsize: int = UPDATE_QUEUE_SIZE, workers: int = UPDATE_WORKERS, window: int = 10000):
+        self.maxsize = maxsize
+        self.workers = workers
+        self._queue = None
+        self._tasks = []
+        self.received = 0
+        self.handled = 0
+        self.failed = 0
+        self.rejected = 0
+        # Время от приёма запроса до конца обработки, секунды
+        self.latencies = deque(maxlen=window)
+
+    def put(self, update: types.Update) -> bool:
+        try:
+            self._queue.put_nowait((time.monotonic(), update))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+        self.received += 1
+        return True
+
+    def __len__(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    def start(self, dispatcher: Dispatcher):
+        self._queue = asyncio.Queue(maxsize=self.maxsize)
+        self._tasks = [asyncio.create_task(self._worker(dispatcher)) for _ in range(self.workers)]
+
+    async def _worker(self, dispatcher: Dispatcher):
+        # Контекст задачи: хэндлеры берут бота и диспетчер через get_current()
+        Bot.set_current(dispatcher.bot)
+        Dispatcher.set_current(dispatcher)
+        while True:
+            received, update = await self._queue.get()
+            try:
+                await dispatcher.updates_handler.notify(update)
+                self.handled += 1
+            except Exception as e:
+                self.failed += 1
+                logging.error(f"[WEBHOOK] Ошибка обработки обновления {update.update_id}: {e}")
+            finally:
+                self.latencies.append(time.monotonic() - received)
+                self._queue.task_done()
+
+    async def stop(self):
+        # Дорабатываем принятое: Telegram уже получил 200 и повторно эти обновления не пришлёт
+        if self._queue is not None and self._queue.qsize():
+            try:
+                await asyncio.wait_for(self._queue.join(), DRAIN_TIMEOUT)
+            except asyncio.TimeoutError:
+                logging.warning(f"[WEBHOOK] При остановке не обработано обновлений: {self._queue.qsize()}")
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    def stats(self) -> dict:
+        return {
+            "depth": len(self),
+            "received": self.received,
+            "handled": self.handled,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "p50": percentile(self.latencies, 0.5),
+            "p99": percentile(self.latencies, 0.99),
+        }
+
+
+update_queue = UpdateQueue()
+
+
+class QueuedWebhookHandler(WebhookRequestHandler):
+    async def post(self):
+        self.validate_ip()
+        secret = self.request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(secret, SECRET_TOKEN):
+            raise web.HTTPUnauthorized()
+        update = await self.parse_update(self.get_dispatcher().bot)
+        if not update_queue.put(update):
+            logging.warning(f"[WEBHOOK] Очередь заполнена, обновление {update.update_id} отклонено")
+            raise web.HTTPServiceUnavailable(headers={"Retry-After": "1"})
+        return web.Response(text="ok")
+
+
+async def _set_webhook(dispatcher: Dispatcher):
+    update_queue.start(dispatcher)
+    # Обновления, пришедшие во время простоя, не сбрасываются — Telegram доставит их сюда
+    await dispatcher.bot.set_webhook(
+        WEBHOOK_URL + WEBHOOK_PATH,
+        secret_token=SECRET_TOKEN,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=types.AllowedUpdates.all(),
+    )
+    logging.info(f"Webhook установлен: {WEBHOOK_URL}{WEBHOOK_PATH}, max_connections={WEBHOOK_MAX_CONNECTIONS}")
+
+
+async def _stop_queue(_):
+    await update_queue.stop()
+
+
+def start_webhook(dispatcher: Dispatcher, on_startup, on_shutdown):
+    executor = Executor(dispatcher, skip_updates=False)
+    executor.on_startup(_set_webhook, polling=False)
+    executor.on_startup(on_startup, polling=False)
+    # Очередь разбирается до закрытия базы в on_shutdown
+    executor.on_shutdown(_stop_queue, polling=False)
+    executor.on_shutdown(on_shutdown, polling=False)
+    executor.start_webhook(webhook_path=WEBHOOK_PATH, request_handler=QueuedWebhookHandler,
+                           host=WEBAPP_HOST, port=WEBAPP_PORT)